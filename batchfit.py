@@ -0,0 +1,234 @@
+"""
+Headless batch fitting of .phd and .csv files
+
+Usage: batchfit.py <file|directory|glob>... [name=value]...
+
+Accepts the fit parameters the sidebar collects (model, timestart, timeend,
+tau, izero, tau2, izero2, tau3, izero3, irfshift, fixed, method) plus `jobs`
+(size of the process pool, all cores by default) and `output` (results
+table, stdout by default). With `irfshift=auto` the IRF shift is searched for every file,
+`cache=1` reuses results stored by earlier fits of the same data.
+`method=mle` fits by Poisson maximum likelihood, for low-count data.
+`bootstrap=1000` adds 95% intervals of every parameter from 1000 Poisson
+resampled copies of the decay. `db=results.sqlite` (or `db=1` for the default
+store) also records every fit in a `resultsdb.ResultsDB`. `save=dat` or
+`save=npz` writes every fit next to its data file (see `fitexport`).
+
+With `global=1` all curves of a file after the IRF (curve 0), or the ones
+listed in `curves=1,2,5`, are fitted together with shared lifetimes and one
+row per curve is written. Results of all files are written as one CSV table.
+"""
+import os
+import sys
+import glob
+import multiprocessing
+
+import core
+import fitting
+from fitcache import FitCache
+from resultsdb import ResultsDB, DEFAULT_PATH, file_metadata
+from datafiles import load_curve_set
+from picoharp import ParseError
+
+EXTENSIONS = ('.phd', '.csv')
+
+PARAMS = ['tau', 'izero', 'tau2', 'izero2', 'tau3', 'izero3']
+
+# bootstrap intervals
+INTERVALS = ['%s_%s' % (p, end) for p in PARAMS for end in ('low', 'high')]
+
+COLUMNS = (['file', 'curve', 'model'] + PARAMS +
+           ['irfshift', 'chisquare', 'deviance'] + INTERVALS + ['error'])
+
+
+def find_files(patterns):
+    """Expand directories and glob patterns into a sorted list of files."""
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = [os.path.join(pattern, n) for n in os.listdir(pattern)]
+        else:
+            names = glob.glob(pattern)
+        files.extend(n for n in names
+                     if n[-4:] in EXTENSIONS and os.path.isfile(n))
+    return sorted(set(files))
+
+
+def parse_args(args):
+    paths = []
+    kwargs = {}
+    for arg in args:
+        if '=' in arg:
+            k, v = arg.split('=', 1)
+            kwargs[k] = v
+        else:
+            paths.append(arg)
+    return paths, kwargs
+
+
+def fit_file(filename, kwargs):
+    """Fit a single file, returns a row of `COLUMNS`."""
+    kwargs = dict(kwargs)
+    cache = None
+    if kwargs.pop('cache', '0') not in ('0', ''):
+        cache = FitCache()
+    samples = int(kwargs.pop('bootstrap', 0) or 0)
+    save = kwargs.pop('save', None)
+    row = dict.fromkeys(COLUMNS, '')
+    row['file'] = filename
+    row['curve'] = 1
+    row['model'] = kwargs.get('model', 'exp1')
+    try:
+        measurement = core.Measurement.load(filename)
+        result = measurement.fit(cache, **kwargs)
+        intervals = {}
+        if samples:
+            # files are already spread over the pool
+            intervals = measurement.bootstrap(result, samples, jobs=1,
+                                              **kwargs).intervals()
+        if save:
+            measurement.save_fit(result, save, intervals=intervals)
+    except (fitting.FitError, ParseError, IOError, ValueError), e:
+        row['error'] = str(e)
+        return row
+    for k, v in result.params.items():
+        row[k] = '%.6g' % v
+    for k, (low, high) in intervals.items():
+        row[k + '_low'] = '%.6g' % low
+        row[k + '_high'] = '%.6g' % high
+    row['irfshift'] = '%.6g' % result.irfshift
+    return row
+
+
+def global_fit_file(filename, kwargs):
+    """Fit the curves of a file together, returns a row per curve."""
+    kwargs = dict(kwargs)
+    kwargs.pop('cache', None)
+    kwargs.pop('bootstrap', None)
+    kwargs.pop('save', None)
+    indices = kwargs.pop('curves', None)
+    row = dict.fromkeys(COLUMNS, '')
+    row['file'] = filename
+    row['model'] = kwargs.get('model', 'exp1')
+    try:
+        if indices:
+            indices = [int(i) for i in indices.split(',')]
+        curves = load_curve_set(filename, indices)
+        if indices is None:
+            indices = range(1, len(curves.decay) + 1)
+        if kwargs.get('irfshift') == 'auto':
+            # one shift for all curves, searched on their sum
+            del kwargs['irfshift']
+            kwargs['irfshift'], _, _ = fitting.find_irf_shift(
+                curves.t, curves.decay.sum(axis=0), curves.irf, **kwargs)
+        result = fitting.global_fit(curves.t, curves.decay, curves.irf,
+                                    **kwargs)
+    except (fitting.FitError, ParseError, IOError, ValueError,
+            IndexError), e:
+        row['error'] = str(e)
+        return [row]
+
+    rows = []
+    for i, index in enumerate(indices):
+        row = dict(row)
+        row['curve'] = index
+        for k, v in result.curve(i).params.items():
+            row[k] = '%.6g' % v
+        row['irfshift'] = '%.6g' % result.irfshift
+        rows.append(row)
+    return rows
+
+
+def _fit_file(args):
+    filename, kwargs = args
+    if kwargs.get('global', '0') not in ('0', ''):
+        kwargs = dict(kwargs)
+        del kwargs['global']
+        return global_fit_file(filename, kwargs)
+    return [fit_file(filename, kwargs)]
+
+
+def db_rows(rows, kwargs):
+    """Rows of the `resultsdb` table for the fitted rows of `COLUMNS`."""
+    metadata = {}
+    r = []
+    for row in rows:
+        if row['error']:
+            continue
+        filename = row['file']
+        if filename not in metadata:
+            try:
+                metadata[filename] = file_metadata(filename)
+            except (IOError, ParseError, ValueError):
+                metadata[filename] = None
+        curves = metadata[filename]
+        curve = int(row['curve'])
+        r.append(dict(curves and curves[curve] or {}))
+        r[-1].update((k, float(row[k]))
+                     for k in (PARAMS + ['irfshift', 'chisquare', 'deviance'] +
+                               INTERVALS)
+                     if row[k] != '')
+        r[-1].update(file=os.path.abspath(filename), curve=curve,
+                     model=row['model'],
+                     method=kwargs.get('method', 'lsq'),
+                     fixed=kwargs.get('fixed', ''),
+                     timestart=kwargs.get('timestart'),
+                     timeend=kwargs.get('timeend'))
+    return r
+
+
+def write_table(f, rows):
+    f.write(','.join(COLUMNS) + '\n')
+    for row in rows:
+        f.write(','.join(str(row[c]).replace(',', ';') for c in COLUMNS))
+        f.write('\n')
+
+
+def main():
+    paths, kwargs = parse_args(sys.argv[1:])
+    if not paths:
+        print __doc__.strip()
+        sys.exit(1)
+
+    jobs = int(kwargs.pop('jobs', 0)) or multiprocessing.cpu_count()
+    output = kwargs.pop('output', None)
+    db = kwargs.pop('db', None)
+
+    files = find_files(paths)
+    if not files:
+        print >> sys.stderr, 'No data files found.'
+        sys.exit(1)
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        tasks = [(f, kwargs) for f in files]
+        chunksize = max(1, len(tasks) // (jobs * 4))
+        rows = []
+        for file_rows in pool.imap(_fit_file, tasks, chunksize):
+            rows.extend(file_rows)
+            for row in file_rows:
+                if row['error']:
+                    print >> sys.stderr, '%s: %s' % (row['file'], row['error'])
+    finally:
+        pool.close()
+        pool.join()
+
+    if db:
+        db = ResultsDB(db != '1' and db or DEFAULT_PATH)
+        try:
+            n = db.insert(db_rows(rows, kwargs))
+        finally:
+            db.close()
+        print >> sys.stderr, 'Recorded %d fits in %s.' % (n, db.path)
+
+    if output:
+        f = open(output, 'w')
+        write_table(f, rows)
+        f.close()
+        print >> sys.stderr, 'Saved %s.' % output
+    else:
+        write_table(sys.stdout, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Benchmarks of the parsing, export, fitting and plotting hot paths
+
+Usage: bench.py [save=1] [baseline=bench_baseline.json] [only=name,...]
+                [repeat=N] [full=1]
+
+Synthetic PicoHarp files of 1 to 512 curves are generated in a temporary
+directory, every benchmark is timed `repeat` times and the best time is
+kept. The times are compared with the baseline file: a benchmark slower than
+its baseline by more than the stored threshold (a factor) is reported and
+the exit status is 1. With `save=1` the baseline is written instead.
+`full=1` adds a 512 x 65536 channel file (128 MB).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+import numpy
+
+import picoharp
+import phd2csv
+import fitting
+import bootstrap
+import datafiles
+import core
+from lod import Pyramid
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_baseline.json')
+
+# allowed slowdown against the baseline before a benchmark fails
+DEFAULT_THRESHOLD = 1.5
+
+# slowdowns below this many seconds are timer noise, not regressions
+NOISE_SECONDS = 0.002
+
+# (curves, channels) of the generated files
+SIZES = [(1, 65536), (64, 65536), (512, 4096)]
+FULL_SIZES = SIZES + [(512, 65536)]
+
+RESOLUTION = 0.016
+
+
+def synthetic_curves(curves, channels, seed=0, taus=(0.8, 3.0),
+                     izeros=(2000, 500), irf_peak=1000, irf_background=0.0):
+    """
+    Poisson noisy IRF in row 0 followed by noisy decays with lifetimes
+    `taus`, or `taus[i]` for decay `i` when given one row per decay.
+    """
+    t = numpy.arange(1, channels + 1) * RESOLUTION
+    irf = (numpy.exp(-0.5 * ((t - 5) / 0.1) ** 2) * irf_peak +
+           irf_background)
+    conv = fitting.Reconvolution(t, irf)
+    per_decay = numpy.ndim(taus) == 2
+    if not per_decay:
+        decay = numpy.maximum(conv(taus, izeros), 0)
+    random = numpy.random.RandomState(seed)
+    data = numpy.empty((curves, channels), numpy.uint32)
+    data[0] = random.poisson(irf)
+    for i in range(1, curves):
+        if per_decay:
+            decay = numpy.maximum(conv(taus[i - 1], izeros), 0)
+        data[i] = random.poisson(decay)
+    return data
+
+
+def write_phd(filename, data, resolution=RESOLUTION, parameter=None):
+    """Write the rows of `data` as a PicoHarp 300 file, `parameter` is the
+    sweep parameter (`P1`) of every curve."""
+    curves, channels = data.shape
+
+    txthdr = numpy.zeros(1, picoharp.TXTHDR)
+    txthdr['Ident'] = 'PicoHarp 300'
+    txthdr['FormatVersion'] = '2.0'
+    txthdr['CreatorName'] = 'bench.py'
+
+    binhdr = numpy.zeros(1, picoharp.BINHDR)
+    binhdr['Curves'] = curves
+    binhdr['NumberOfBoards'] = 1
+    binhdr['BitsPerHistoBin'] = 32
+
+    board = numpy.zeros(1, picoharp.BOARDHDR)
+    board['HardwareIdent'] = 'PicoHarp 300'
+    board['Resolution'] = resolution
+
+    offset = (picoharp.TXTHDR.itemsize + picoharp.BINHDR.itemsize +
+              picoharp.BOARDHDR.itemsize + picoharp.CURVEHDR.itemsize * curves)
+    headers = numpy.zeros(curves, picoharp.CURVEHDR)
+    headers['CurveIndex'] = numpy.arange(curves)
+    headers['Resolution'] = resolution
+    headers['Channels'] = channels
+    headers['DataOffset'] = offset + numpy.arange(curves) * channels * 4
+    headers['IntegralCount'] = data.sum(axis=1)
+    if parameter is not None:
+        headers['P1'] = parameter
+
+    f = open(filename, 'wb')
+    try:
+        for part in (txthdr, binhdr, board, headers):
+            f.write(part.tostring())
+        f.write(data.astype('<u4').tostring())
+    finally:
+        f.close()
+
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def _read_all(filename):
+    parser = picoharp.PicoharpParser(filename)
+    for i in range(parser.no_of_curves()):
+        parser.get_curve(i)
+    parser.close()
+
+
+def benchmarks(directory, sizes):
+    """Yield `(name, func)` of all benchmarks, writing their input files."""
+    for curves, channels in sizes:
+        tag = '%dx%d' % (curves, channels)
+        data = synthetic_curves(curves, channels)
+        phd = os.path.join(directory, 'bench-%s.phd' % tag)
+        write_phd(phd, data)
+
+        yield 'parse_open_%s' % tag, lambda phd=phd: (
+            picoharp.PicoharpParser(phd).close())
+        yield 'get_curve_%s' % tag, lambda phd=phd: _read_all(phd)
+        yield 'phd2csv_%s' % tag, lambda phd=phd: phd2csv.convert(phd)
+        yield 'phd2npz_%s' % tag, lambda phd=phd: (
+            phd2csv.convert(phd, format='npz'))
+
+        if curves * channels <= 64 * 65536:
+            csv = phd2csv.convert(phd)
+            yield 'csv_parse_%s' % tag, lambda csv=csv: (
+                datafiles.CSVFileParser(csv))
+
+    data = synthetic_curves(2, 4000)
+    t = numpy.arange(1, 4001) * RESOLUTION
+    yield 'fit_exp2', lambda: fitting.fit(t, data[1], data[0], model='exp2',
+                                          tau='1', tau2='2')
+    yield 'fit_exp2_mle', lambda: fitting.fit(t, data[1], data[0],
+                                              model='exp2', tau='1',
+                                              tau2='2', method='mle')
+
+    result = fitting.fit(t, data[1], data[0], model='exp2', tau='1', tau2='2')
+    yield 'bootstrap_200', lambda: bootstrap.bootstrap(
+        t, data[1], data[0], result, 200, jobs=1, seed=0)
+
+    data = synthetic_curves(17, 4000)
+    yield 'global_fit_16', lambda: fitting.global_fit(
+        t, data[1:], data[0], model='exp2', tau='1', tau2='2')
+
+    data = synthetic_curves(2, 65536)
+    t = numpy.arange(1, 65537) * RESOLUTION
+
+    def plot():
+        pyramid = Pyramid(t, data[1])
+        for pixels in (400, 800, 1600):
+            pyramid.select(t[0], t[-1], pixels)
+            pyramid.select(t[1000], t[3000], pixels)
+    yield 'lod_65536', plot
+
+    # what loading a file in the GUI costs, drawn headless with Agg
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    phd = os.path.join(directory, 'bench-load.phd')
+    write_phd(phd, data)
+
+    def load_draw():
+        curves = core.Measurement.load(phd).curves
+        figure = Figure()
+        canvas = FigureCanvasAgg(figure)
+        ax = figure.add_subplot(111)
+        for y, style in ((curves.decay, 'b.'), (curves.irf, 'r.')):
+            x, y = Pyramid(curves.t, y).select(-numpy.inf, numpy.inf,
+                                                ax.bbox.width)
+            ax.plot(x, y, style)
+        ax.set_yscale('log')
+        canvas.draw()
+    yield 'load_draw', load_draw
+
+
+def load_baseline(filename):
+    try:
+        f = open(filename)
+    except IOError:
+        return {}
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def save_baseline(filename, results, old):
+    baseline = dict(old)
+    for name, seconds in results:
+        threshold = old.get(name, {}).get('threshold', DEFAULT_THRESHOLD)
+        baseline[name] = {'seconds': round(seconds, 6),
+                          'threshold': threshold}
+    f = open(filename, 'w')
+    try:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+    finally:
+        f.close()
+
+
+def compare(results, baseline):
+    """Lines of a report and the names of regressed benchmarks."""
+    lines = []
+    regressions = []
+    for name, seconds in results:
+        entry = baseline.get(name)
+        if not entry:
+            lines.append('%-24s %10.4fs' % (name, seconds))
+            continue
+        ratio = seconds / max(entry['seconds'], 1e-9)
+        status = ''
+        if (ratio > entry.get('threshold', DEFAULT_THRESHOLD) and
+                seconds - entry['seconds'] > NOISE_SECONDS):
+            status = 'REGRESSION'
+            regressions.append(name)
+        lines.append('%-24s %10.4fs %10.4fs %6.2fx %s' % (
+            name, seconds, entry['seconds'], ratio, status))
+    return lines, regressions
+
+
+def main():
+    kwargs = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)
+    if len(kwargs) != len(sys.argv[1:]):
+        print __doc__.strip()
+        sys.exit(1)
+
+    filename = kwargs.get('baseline', DEFAULT_BASELINE)
+    repeat = int(kwargs.get('repeat', 3))
+    only = kwargs.get('only')
+    only = only and only.split(',')
+    sizes = kwargs.get('full', '0') not in ('0', '') and FULL_SIZES or SIZES
+
+    directory = tempfile.mkdtemp(prefix='bench-')
+    results = []
+    try:
+        for name, func in benchmarks(directory, sizes):
+            if only and not any(name.startswith(o) for o in only):
+                continue
+            results.append((name, best_time(func, repeat)))
+            print >> sys.stderr, '%-24s %10.4fs' % results[-1]
+    finally:
+        shutil.rmtree(directory)
+
+    baseline = load_baseline(filename)
+    if kwargs.get('save', '0') not in ('0', ''):
+        save_baseline(filename, results, baseline)
+        print 'Saved %s.' % filename
+        return
+
+    lines, regressions = compare(results, baseline)
+    print '\n'.join(lines)
+    if regressions:
+        print >> sys.stderr, 'Slower than baseline: %s' % ', '.join(regressions)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Bootstrap confidence intervals of fit parameters
+
+The decay histogram is resampled with Poisson noise, every copy is refitted
+starting from the parameters of the main fit and the percentiles of the
+refitted parameters give the intervals. Copies are fitted in batches with
+`fitting.batch_fit`, the batches are spread over a process pool.
+"""
+import numpy as np
+
+import fitting
+from fitting import TAU_KEYS, IZERO_KEYS
+
+DEFAULT_SAMPLES = 1000
+DEFAULT_LEVEL = 0.95
+
+# resampled copies fitted together in one batch
+BATCH_SIZE = 50
+
+
+class BootstrapResult(object):
+    """
+    Refitted `taus` and `izeros` of every resampled copy, one row each, and
+    the `result` of the main fit.
+    """
+
+    def __init__(self, result, taus, izeros, level=DEFAULT_LEVEL):
+        self.result = result
+        self.taus = taus
+        self.izeros = izeros
+        self.level = level
+
+    def __repr__(self):
+        return 'BootstrapResult<samples: %s, level: %s>' % (len(self),
+                                                            self.level)
+
+    def __len__(self):
+        return len(self.taus)
+
+    def intervals(self):
+        """`(low, high)` percentile interval by parameter name."""
+        tail = (1 - self.level) / 2 * 100
+        r = {}
+        n = self.taus.shape[1]
+        for keys, values in ((TAU_KEYS, self.taus),
+                             (IZERO_KEYS, self.izeros)):
+            low, high = np.percentile(values, [tail, 100 - tail], axis=0)
+            for i in range(n):
+                r[keys[i]] = (low[i], high[i])
+        return r
+
+    def text(self):
+        """Intervals as `name_low value` and `name_high value` lines."""
+        intervals = self.intervals()
+        r = ['samples %d' % len(self)]
+        n = self.taus.shape[1]
+        for i in range(n):
+            for key in (TAU_KEYS[i], IZERO_KEYS[i]):
+                low, high = intervals[key]
+                r.append('%s_low %.6g' % (key, low))
+                r.append('%s_high %.6g' % (key, high))
+        return '\n'.join(r)
+
+
+def _fit_batch(args):
+    t, decay, irf, count, seed, kwargs = args
+    random = np.random.RandomState(seed)
+    decays = random.poisson(np.maximum(decay, 0), (count, len(decay)))
+    # weights of the measured decay for every copy: weights from the noisy
+    # copies themselves would add their bias on top of the main fit's
+    taus, izeros, _ = fitting.batch_fit(t, decays, irf, weight_counts=decay,
+                                        **kwargs)
+    return taus, izeros
+
+
+def bootstrap(t, decay, irf, result, samples=DEFAULT_SAMPLES,
+              level=DEFAULT_LEVEL, jobs=None, seed=None, callback=None,
+              **kwargs):
+    """
+    Intervals of the parameters of `result`, the fit of `decay` with the
+    fit arguments `kwargs`.
+
+    `jobs=1` fits all batches in this process, otherwise a pool of `jobs`
+    processes (all cores by default) is used. `callback(done, samples)` is
+    called after every batch, returning true stops with `FitCancelled`.
+    """
+    kwargs = dict(kwargs)
+    for key in ('model', 'irfshift', 'fixed', 'callback'):
+        kwargs.pop(key, None)
+    # warm start every copy from the main fit
+    for i in range(len(result.taus)):
+        kwargs[TAU_KEYS[i]] = result.taus[i]
+        kwargs[IZERO_KEYS[i]] = result.izeros[i]
+    kwargs.update(model=result.model, irfshift=result.irfshift,
+                  fixed=result.fixed, method=result.method)
+
+    t = np.asarray(t, dtype=np.float64)
+    decay = np.asarray(decay, dtype=np.float64)
+    irf = np.asarray(irf, dtype=np.float64)
+
+    starts = range(0, samples, BATCH_SIZE)
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1,
+                                                size=len(starts))
+    tasks = []
+    for start, batch_seed in zip(starts, seeds):
+        count = min(BATCH_SIZE, samples - start)
+        tasks.append((t, decay, irf, count, batch_seed, kwargs))
+
+    batches = fitting.map_batches(_fit_batch, tasks, samples, jobs, callback)
+    taus, izeros = [np.vstack(x) for x in zip(*batches)]
+    return BootstrapResult(result, taus, izeros, level)
@@ -0,0 +1,143 @@
+"""
+Fitting workflow without a user interface
+
+load -> preprocess -> IRF shift -> fit -> results on plain numpy arrays.
+Nothing here imports gtk, gobject or matplotlib, so scripts and batch jobs
+can use it directly; the GUI is a client of `Measurement`:
+
+    m = Measurement.load('data.phd')
+    m.irfshift = m.find_irf_shift(model='exp2')
+    result = m.fit(model='exp2', timestart=27, timeend=60)
+    print result.text()
+"""
+import itertools
+
+import fitting
+import fitexport
+from bootstrap import DEFAULT_SAMPLES, bootstrap as bootstrap_fit
+from datafiles import load_curves
+from picoharp import ParseError
+from resultsdb import file_metadata
+
+FORM_KEYS = ('timestart', 'timeend', 'tau', 'izero', 'tau2', 'izero2',
+             'tau3', 'izero3', 'irfshift')
+
+
+def fit_kwargs(model='exp1', fixed=(), method='lsq', **values):
+    """
+    Fit keyword arguments from the fields of a fit form: empty values are
+    left out, `fixed` lists the taus to hold.
+    """
+    kwargs = {'model': model}
+    for key in FORM_KEYS:
+        value = values.get(key)
+        if isinstance(value, basestring):
+            value = value.strip()
+        if value not in (None, ''):
+            kwargs[key] = value
+    if fixed:
+        kwargs['fixed'] = ','.join(fixed)
+    if method != 'lsq':
+        kwargs['method'] = method
+    return kwargs
+
+
+class Measurement(object):
+    """
+    Decay and IRF of one data file and the IRF shift to fit them with.
+    """
+
+    def __init__(self, filename, curves, irfshift=0.0):
+        self.filename = filename
+        self.curves = curves
+        self.irfshift = irfshift
+
+    def __repr__(self):
+        return 'Measurement<%s, irfshift: %s>' % (self.filename,
+                                                  self.irfshift)
+
+    @classmethod
+    def load(cls, filename, cache=None):
+        """Read a data file, through a `datafiles.CurveCache` if given."""
+        if cache is not None:
+            return cls(filename, cache.get(filename))
+        return cls(filename, load_curves(filename))
+
+    @property
+    def resolution(self):
+        return self.curves.resolution
+
+    def data(self):
+        """
+        Fit input as arrays: time axis, decay and IRF. The IRF is not
+        shifted here, the fit applies `irfshift` itself.
+        """
+        return self.curves.t, self.curves.decay, self.curves.irf
+
+    def shifted_irf(self):
+        """The IRF with `irfshift` applied the way the fit applies it."""
+        return fitting.shift_irf(self.curves.irf, self.irfshift,
+                                 self.resolution)
+
+    def iter_data(self):
+        """`(t, decay, irf)` rows with the IRF shifted by `irfshift`."""
+        return itertools.izip(self.curves.t, self.curves.decay,
+                              self.shifted_irf())
+
+    def _kwargs(self, kwargs):
+        kwargs = dict(kwargs)
+        if kwargs.get('irfshift') in (None, ''):
+            kwargs['irfshift'] = self.irfshift
+        return kwargs
+
+    def find_irf_shift(self, **kwargs):
+        """Best IRF shift for the fit settings `kwargs`."""
+        t, decay, irf = self.data()
+        shift, _, _ = fitting.find_irf_shift(t, decay, irf, **kwargs)
+        return shift
+
+    def fit(self, cache=None, callback=None, **kwargs):
+        """
+        Fit with `fitting.fit` keyword arguments, through a
+        `fitcache.FitCache` if given. `irfshift='auto'` searches the shift
+        first, no `irfshift` uses the one set on the measurement. A cached
+        result skips the shift search too.
+        """
+        kwargs = self._kwargs(kwargs)
+        t, decay, irf = self.data()
+        if cache is not None:
+            return cache.fit(t, decay, irf, callback=callback, **kwargs)
+        if kwargs['irfshift'] == 'auto':
+            del kwargs['irfshift']
+            kwargs['irfshift'] = self.find_irf_shift(callback=callback,
+                                                        **kwargs)
+        return fitting.fit(t, decay, irf, callback=callback, **kwargs)
+
+    def bootstrap(self, result, samples=DEFAULT_SAMPLES, jobs=None,
+                  callback=None, **kwargs):
+        """Bootstrap intervals of `result`, a fit of this measurement with
+        the fit arguments `kwargs`."""
+        t, decay, irf = self.data()
+        return bootstrap_fit(t, decay, irf, result, samples, jobs=jobs,
+                             callback=callback, **kwargs)
+
+    def save_fit(self, result, format='dat', filename=None, intervals=None):
+        """
+        Write `result` next to the data file (`data.phd` -> `data.dat`) or
+        to `filename`, with the bootstrap `intervals` if given, see
+        `fitexport`. Returns the name written.
+        """
+        filename = filename or fitexport.fit_filename(self.filename, format)
+        try:
+            # the decay is curve 1
+            metadata = file_metadata(self.filename)[1]
+        except (IOError, ParseError, ValueError, IndexError):
+            metadata = None
+        t, decay, irf = self.data()
+        return fitexport.save_fit(filename, t, decay, irf, result, metadata,
+                                  intervals)
+
+
+def fit_file(filename, cache=None, **kwargs):
+    """Load a data file and fit it, returns a `fitting.FitResult`."""
+    return Measurement.load(filename).fit(cache=cache, **kwargs)
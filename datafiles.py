@@ -0,0 +1,269 @@
+"""
+Loading decay and IRF curves from data files
+"""
+import os
+import bisect
+import threading
+import collections
+import Queue
+
+import numpy
+
+import timing
+from picoharp import PicoharpParser
+from preprocess import prepare
+
+
+CSV_RESOLUTION = 0.0016
+CSV_CHUNK_LINES = 65536
+
+
+def _sniff_delimiter(line):
+    for char in (',', ';'):
+        if char in line:
+            return char
+    return None
+
+
+def _parse_line(line, delimiter, columns):
+    row = [0.0] * columns
+    for i, value in enumerate(line.split(delimiter)[:columns]):
+        try:
+            row[i] = float(value)
+        except ValueError:
+            pass
+    return row
+
+
+def _parse_lines(lines, delimiter, columns):
+    text = ''.join(lines)
+    if delimiter:
+        text = text.replace(delimiter, ' ')
+    values = numpy.fromstring(text, dtype=numpy.float64, sep=' ')
+    if values.size == len(lines) * columns:
+        return values.reshape(len(lines), columns)
+    # headers or broken fields, fall back to parsing line by line
+    return numpy.array([_parse_line(l, delimiter, columns) for l in lines],
+                       dtype=numpy.float64)
+
+
+class CSVFileParser(object):
+    """
+    Parser for CSV files with one curve per column.
+
+    The file is read once in chunks of `CSV_CHUNK_LINES` lines. If the first
+    column holds increasing non-integer values it is taken as the time axis
+    (as written by phd2csv.py): it gives the resolution and is not counted
+    as a curve.
+    """
+
+    def __init__(self, filename):
+        f = open(filename, 'r')
+        try:
+            self._parse(f)
+        finally:
+            f.close()
+
+    def _parse(self, f):
+        delimiter = columns = None
+        chunks = []
+        lines = []
+        for line in f:
+            if not line.strip():
+                continue
+            if columns is None:
+                delimiter = _sniff_delimiter(line)
+                columns = len(line.split(delimiter))
+            lines.append(line)
+            if len(lines) == CSV_CHUNK_LINES:
+                chunks.append(_parse_lines(lines, delimiter, columns))
+                lines = []
+        if lines:
+            chunks.append(_parse_lines(lines, delimiter, columns))
+
+        if not chunks:
+            self.resolution = CSV_RESOLUTION
+            self._curves = numpy.zeros((0, 0), numpy.int64)
+            return
+
+        data = numpy.vstack(chunks).T
+        time = data[0]
+        if (len(data) > 1 and len(time) > 1 and
+                numpy.any(time != numpy.round(time)) and
+                numpy.all(numpy.diff(time) > 0)):
+            self.resolution = (time[-1] - time[0]) / (len(time) - 1)
+            data = data[1:]
+        else:
+            self.resolution = CSV_RESOLUTION
+
+        self._curves = numpy.rint(data).astype(numpy.int64)
+
+    def no_of_curves(self):
+        return len(self._curves)
+
+    def get_curve(self, n):
+        return self.resolution, self._curves[n]
+
+    def curves(self):
+        return self._curves
+
+    def sweep_parameter(self):
+        return numpy.arange(len(self._curves), dtype=numpy.float64)
+
+
+def get_file_parser(filename):
+    d = {
+        '.csv': CSVFileParser,
+        '.phd': PicoharpParser,
+    }
+    filename[-4]
+    return d[filename[-4:]](filename)
+
+
+def load_curves(filename):
+    """
+    Read IRF (curve 0) and decay (curve 1) from a data file and prepare them
+    with `preprocess.prepare`.
+    """
+    data = get_file_parser(filename)
+    try:
+        if data.no_of_curves() < 2:
+            raise ValueError('%s has no decay curve besides the IRF.' %
+                             os.path.basename(filename))
+        res, irf = data.get_curve(0)
+        res, decay = data.get_curve(1)
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
+    with timing.timer('prepare'):
+        return prepare(res, irf, decay)
+
+
+def load_curve_set(filename, indices=None):
+    """
+    Like `load_curves` but with the decays of curves `indices` (all but the
+    IRF by default) stacked into one 2-D array.
+    """
+    data = get_file_parser(filename)
+    try:
+        curves = data.curves()
+        res, irf = data.get_curve(0)
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
+    if indices is None:
+        indices = range(1, len(curves))
+    return prepare(res, irf, curves[list(indices)])
+
+
+_listings = {}
+
+
+def list_files(d, ext, _listdir=os.listdir):
+    """
+    Sorted names of files in directory `d` ending with `ext`. Listings of
+    real directories are cached until the directory is modified.
+    """
+    if _listdir is not os.listdir:
+        return sorted(n for n in _listdir(d or os.curdir) if n.endswith(ext))
+
+    mtime = os.stat(d or os.curdir).st_mtime
+    cached = _listings.get((d, ext))
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    files = sorted(n for n in _listdir(d or os.curdir) if n.endswith(ext))
+    _listings[(d, ext)] = (mtime, files)
+    return files
+
+
+def get_next_file(filename, i=1, _listdir=os.listdir):
+    """
+    >>> ls = lambda n: ['a.txt', 'b.doc', 'c.txt']
+    >>> get_next_file('a.txt', 1, ls)
+    'c.txt'
+    >>> get_next_file('a.txt', -1, ls)
+    'c.txt'
+    >>> get_next_file('c.txt', -1, ls)
+    'a.txt'
+    >>> get_next_file('c.txt', 1, ls)
+    'a.txt'
+    """
+    d, filename = os.path.split(filename)
+    name, ext = filename.rsplit('.', 1)
+    files = list_files(d, ext, _listdir)
+    index = bisect.bisect_left(files, filename)
+    if index == len(files) or files[index] != filename:
+        raise ValueError('%s is not in %s' % (filename, d or os.curdir))
+    index = (index + i) % len(files)
+    return os.path.join(d, files[index])
+
+
+class CurveCache(object):
+    """
+    Bounded LRU cache of `load_curves` results keyed by path and mtime.
+
+    `prefetch` loads files on a background thread, so stepping to a
+    neighbouring file finds it already parsed. Cached arrays are read-only.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = None
+
+    def _key(self, filename):
+        st = os.stat(filename)
+        return os.path.abspath(filename), st.st_mtime, st.st_size
+
+    def _lookup(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def _store(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __contains__(self, filename):
+        try:
+            key = self._key(filename)
+        except OSError:
+            return False
+        with self._lock:
+            return key in self._items
+
+    def get(self, filename):
+        key = self._key(filename)
+        value = self._lookup(key)
+        timing.count(value is None and 'file cache miss' or 'file cache hit')
+        if value is None:
+            value = load_curves(filename)
+            for array in (value.irf, value.decay):
+                array.flags.writeable = False
+            self._store(key, value)
+        return value
+
+    def prefetch(self, filenames):
+        if self._queue is None:
+            self._queue = Queue.Queue()
+            thread = threading.Thread(target=self._prefetch_loop)
+            thread.daemon = True
+            thread.start()
+        for filename in filenames:
+            self._queue.put(filename)
+
+    def _prefetch_loop(self):
+        while True:
+            filename = self._queue.get()
+            try:
+                self.get(filename)
+            except Exception:
+                # the error surfaces when the file is actually opened
+                pass
@@ -0,0 +1,172 @@
+"""
+On-disk cache of fit results
+
+Results are stored as one .npz file per fit in a cache directory, named by a
+hash of the fit input (time axis, decay, IRF) and the fit parameters. Reading
+a result touches its file, when the directory grows over `max_bytes` the
+least recently used results are removed.
+"""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+import fitting
+from fitting import FitResult
+from timing import timer
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'picoharp300-curvefit', 'fits')
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+
+def _normalize(key, value):
+    if key == 'fixed':
+        if isinstance(value, basestring):
+            value = value.split(',')
+        return ','.join(sorted(v.strip() for v in value if v.strip()))
+    try:
+        return repr(float(value))
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def fit_key(t, decay, irf, kwargs):
+    """Hash of the fit input and parameters."""
+    h = hashlib.sha1()
+    for array in (t, decay, irf):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        h.update(str(array.shape))
+        h.update(array.tostring())
+    for key in sorted(kwargs):
+        if key == 'callback' or kwargs[key] in (None, ''):
+            continue
+        h.update('%s=%s\n' % (key, _normalize(key, kwargs[key])))
+    return h.hexdigest()
+
+
+def save_result(filename, result):
+    np.savez(filename,
+             model=result.model,
+             t=result.t,
+             fit=result.fit,
+             residuals=result.residuals,
+             taus=result.taus,
+             izeros=result.izeros,
+             chisquare=result.chisquare,
+             fixed=','.join(result.fixed),
+             irfshift=result.irfshift,
+             nfev=result.nfev,
+             method=result.method,
+             deviance=np.nan if result.deviance is None else result.deviance,
+             errors=np.zeros(0) if result.errors is None else result.errors)
+
+
+def load_result(filename):
+    data = np.load(filename)
+    try:
+        fixed = str(data['fixed'])
+        deviance = errors = None
+        if 'errors' in data.files and len(data['errors']):
+            errors = data['errors']
+        if 'deviance' in data.files and not np.isnan(data['deviance']):
+            deviance = float(data['deviance'])
+        return FitResult(
+            model=str(data['model']),
+            t=data['t'],
+            fit=data['fit'],
+            residuals=data['residuals'],
+            taus=data['taus'],
+            izeros=data['izeros'],
+            chisquare=float(data['chisquare']),
+            fixed=tuple(fixed.split(',')) if fixed else (),
+            irfshift=float(data['irfshift']),
+            nfev=int(data['nfev']),
+            method=str(data['method']) if 'method' in data.files else 'lsq',
+            deviance=deviance,
+            errors=errors,
+        )
+    finally:
+        data.close()
+
+
+class FitCache(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created meanwhile by another batch worker
+                if not os.path.isdir(directory):
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            result = load_result(path)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        f, tmp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        os.close(f)
+        try:
+            save_result(tmp, result)
+            os.rename(tmp, self._path(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used results until under `max_bytes`."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def fit(self, t, decay, irf, **kwargs):
+        """
+        `fitting.fit` that returns the stored result for a known input and
+        stores new results. `irfshift='auto'` is part of the key, the shift
+        is only searched when the result is not stored yet.
+        """
+        with timer('cache lookup'):
+            key = fit_key(t, decay, irf, kwargs)
+            result = self.get(key)
+        if result is None:
+            if kwargs.get('irfshift') == 'auto':
+                kwargs['irfshift'], _, _ = fitting.find_irf_shift(
+                    t, decay, irf, **kwargs)
+            result = fitting.fit(t, decay, irf, **kwargs)
+            with timer('cache store'):
+                self.put(key, result)
+        return result
@@ -0,0 +1,107 @@
+"""
+Writing fits to disk
+
+A saved fit is a table of the fit window: time, decay, IRF, fit and
+residuals. `.dat` is tab separated text with the fit parameters, their
+standard errors and bootstrap intervals in `#` comments, readable with
+`numpy.loadtxt`; `.npz` holds the columns as arrays next to the parameters
+and the curve header metadata:
+
+    f = numpy.load('data.npz')
+    f['t'], f['fit'], f['tau'], f['header_resolution']
+
+Both are written with a handful of numpy calls however long the curve is, so
+saving every fit of a directory in a batch job costs little.
+"""
+import os
+
+import numpy as np
+
+import fitting
+
+FORMATS = ('dat', 'npz')
+
+COLUMNS = ('t', 'decay', 'irf', 'fit', 'residuals')
+
+# the decay is counts, a shifted IRF is not
+_DAT_FORMAT = '%.6g\t%d\t%.6g\t%.6g\t%.6g\n'
+
+
+def fit_filename(filename, format='dat'):
+    """`data.phd` -> `data.dat`, other names get the suffix appended."""
+    base, ext = os.path.splitext(filename)
+    if ext.lower() not in ('.phd', '.csv'):
+        base = filename
+    return '%s.%s' % (base, format)
+
+
+def fit_table(t, decay, irf, result):
+    """
+    Rows of `COLUMNS` for the fit window of `result`, a fit of `decay` and
+    `irf` over the time axis `t`. The IRF column is shifted by
+    `result.irfshift`.
+    """
+    t = np.asarray(t)
+    start = np.searchsorted(t, result.t[0])
+    stop = start + len(result.t)
+    if stop > len(t) or not np.allclose(t[start:stop], result.t):
+        raise ValueError('The fit does not match the time axis.')
+    # the IRF as the fit saw it
+    irf = fitting.shift_irf(irf, result.irfshift, t[1] - t[0])
+    return np.column_stack((result.t, decay[start:stop], irf[start:stop],
+                            result.fit, result.residuals))
+
+
+def _params(result, intervals=None):
+    r = dict(result.params)
+    for key, value in result.uncertainties.items():
+        r[key + '_error'] = value
+    for key, (low, high) in (intervals or {}).items():
+        r[key + '_low'] = low
+        r[key + '_high'] = high
+    r['irfshift'] = result.irfshift
+    return r
+
+
+def write_dat(f, table, result, metadata=None, intervals=None):
+    f.write('# model %s\n# method %s\n' % (result.model, result.method))
+    for key, value in sorted(_params(result, intervals).items()):
+        f.write('# %s %.6g\n' % (key, value))
+    for key, value in sorted((metadata or {}).items()):
+        f.write('# header_%s %s\n' % (key, value))
+    f.write('# %s\n' % '\t'.join(COLUMNS))
+    # one formatting call for the whole table
+    f.write(_DAT_FORMAT * len(table) % tuple(table.ravel()))
+
+
+def write_npz(f, table, result, metadata=None, intervals=None):
+    arrays = dict(zip(COLUMNS, table.T))
+    arrays.update(_params(result, intervals))
+    arrays.update(model=result.model, method=result.method,
+                  fixed=','.join(result.fixed))
+    for key, value in (metadata or {}).items():
+        arrays['header_' + key] = value
+    np.savez(f, **arrays)
+
+
+def save_fit(filename, t, decay, irf, result, metadata=None,
+             intervals=None):
+    """
+    Write `result` to `filename`, in the format its extension names.
+    `metadata` is a dict of curve header values, see
+    `resultsdb.file_metadata`, `intervals` the bootstrap intervals by
+    parameter name, written as `name_low` and `name_high`.
+    """
+    format = os.path.splitext(filename)[1][1:].lower()
+    if format not in FORMATS:
+        raise ValueError('Unknown fit format: %s' % format)
+    table = fit_table(t, decay, irf, result)
+    f = open(filename, 'wb')
+    try:
+        if format == 'npz':
+            write_npz(f, table, result, metadata, intervals)
+        else:
+            write_dat(f, table, result, metadata, intervals)
+    finally:
+        f.close()
+    return filename
@@ -0,0 +1,779 @@
+"""
+In-process multi-exponential reconvolution fitting
+
+The decay is modelled as a sum of exponentials convolved with the measured
+instrument response function (IRF). Convolution is done with FFTs, all
+exponential components of a model are transformed in one batch.
+"""
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+from scipy.optimize import least_squares
+
+from preprocess import time_window
+from timing import timer
+
+MODELS = {
+    'exp1': 1,
+    'exp2': 2,
+    'exp3': 3,
+}
+
+METHODS = ('lsq', 'mle')
+
+TAU_KEYS = ('tau', 'tau2', 'tau3')
+IZERO_KEYS = ('izero', 'izero2', 'izero3')
+
+
+# floor of the model in the Poisson likelihood, the model is ~0 ahead of
+# the IRF
+MIN_COUNTS = 1e-9
+
+
+class FitError(Exception): pass
+
+
+class FitCancelled(FitError): pass
+
+
+def _fft_size(n):
+    """Smallest power of two that holds a linear convolution of two
+    n-sized arrays."""
+    size = 1
+    while size < 2 * n:
+        size *= 2
+    return size
+
+
+def _float(value, default=None):
+    if value is None or value == '':
+        return default
+    return float(value)
+
+
+def _fixed(value):
+    if not value:
+        return ()
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return tuple(v.strip() for v in value if v.strip())
+
+
+def shift_irf(irf, shift, resolution):
+    """
+    `irf` delayed by `shift` (time units, negative advances it), the shift
+    fits apply through `Reconvolution.phase`. Whole bins move the counts
+    exactly, the rest of a bin is applied as a Fourier phase. Bins shifted
+    in from outside the curve are empty.
+    """
+    irf = np.asarray(irf, dtype=np.float64)
+    if not shift:
+        return irf
+    n = len(irf)
+    bins = shift / resolution
+    whole = max(-n, min(n, int(round(bins))))
+    shifted = np.zeros(n)
+    if whole >= 0:
+        shifted[whole:] = irf[:n - whole]
+    else:
+        shifted[:n + whole] = irf[-whole:]
+    fraction = bins - whole
+    # float resolutions make whole-bin shifts a hair off
+    if abs(fraction) > 1e-6:
+        nfft = _fft_size(n)
+        freq = np.fft.rfftfreq(nfft, resolution)
+        spectrum = np.fft.rfft(shifted, nfft)
+        spectrum *= np.exp(-2j * np.pi * freq * fraction * resolution)
+        shifted = np.fft.irfft(spectrum, nfft)[:n]
+    return shifted
+
+
+class Reconvolution(object):
+    """
+    Multi-exponential decay reconvolved with an IRF on a fixed time grid.
+
+    The IRF is normalised to unit area, so `izero` is the amplitude of the
+    exponential before convolution.
+    """
+
+    def __init__(self, t, irf, shift=0.0):
+        t = np.asarray(t, dtype=np.float64)
+        irf = np.asarray(irf, dtype=np.float64)
+
+        if len(t) < 2 or len(t) != len(irf):
+            raise FitError('Time axis and IRF must have the same size.')
+
+        total = irf.sum()
+        if total <= 0:
+            raise FitError('IRF curve is empty.')
+
+        self.size = len(t)
+        self.nfft = _fft_size(self.size)
+        self.resolution = t[1] - t[0]
+        self.t = t - t[0]
+
+        self.freq = np.fft.rfftfreq(self.nfft, self.resolution)
+        self.irf_spectrum = np.fft.rfft(irf / total, self.nfft)
+        if shift:
+            self.irf_spectrum = self.irf_spectrum * self.phase(shift)
+
+    def phase(self, shifts):
+        """Fourier factors that delay a curve by `shifts` (time units)."""
+        shifts = np.asarray(shifts, dtype=np.float64)[..., None]
+        return np.exp(-2j * np.pi * self.freq * shifts)
+
+    def convolve(self, curves):
+        """Convolve every row of `curves` with the IRF."""
+        spectrum = np.fft.rfft(curves, self.nfft, axis=-1)
+        spectrum *= self.irf_spectrum
+        return np.fft.irfft(spectrum, self.nfft, axis=-1)[..., :self.size]
+
+    def components(self, taus):
+        """Convolved unit-amplitude exponentials, one row per tau."""
+        taus = np.asarray(taus, dtype=np.float64)[..., None]
+        return self.convolve(np.exp(-self.t / taus))
+
+    def shifted_components(self, taus, shifts):
+        """
+        Convolved unit-amplitude exponentials for every IRF shift at once,
+        an array of shape (shifts, taus, time).
+        """
+        taus = np.asarray(taus, dtype=np.float64)[:, None]
+        spectrum = np.fft.rfft(np.exp(-self.t / taus), self.nfft, axis=-1)
+        spectrum = (spectrum[None, :, :] * self.irf_spectrum *
+                    self.phase(shifts)[:, None, :])
+        return np.fft.irfft(spectrum, self.nfft, axis=-1)[..., :self.size]
+
+    def __call__(self, taus, izeros):
+        return np.dot(izeros, self.components(taus))
+
+    def evaluate(self, taus, izeros):
+        """
+        Model and its partial derivatives.
+
+        Returns `(model, d_tau, d_izero)` where the derivative arrays hold
+        one row per exponential component. `taus` and `izeros` may have
+        leading dimensions to evaluate a stack of models in one batch.
+        """
+        taus = np.asarray(taus, dtype=np.float64)[..., None]
+        izeros = np.asarray(izeros, dtype=np.float64)[..., None]
+        exps = np.exp(-self.t / taus)
+        rows = np.concatenate((exps, izeros * exps * self.t / taus ** 2),
+                              axis=-2)
+        conv = self.convolve(rows)
+        n = taus.shape[-2]
+        d_izero = conv[..., :n, :]
+        d_tau = conv[..., n:, :]
+        model = (izeros * d_izero).sum(axis=-2)
+        return model, d_tau, d_izero
+
+
+class FitResult(object):
+    """Outcome of a single fit, `t`, `fit` and `residuals` cover only the
+    fitted time window."""
+
+    def __init__(self, model, t, fit, residuals, taus, izeros, chisquare,
+                 fixed=(), irfshift=0.0, nfev=0, method='lsq', deviance=None,
+                 errors=None):
+        self.model = model
+        self.t = t
+        self.fit = fit
+        self.residuals = residuals
+        self.taus = taus
+        self.izeros = izeros
+        self.chisquare = chisquare
+        self.fixed = fixed
+        self.irfshift = irfshift
+        self.nfev = nfev
+        self.method = method
+        self.deviance = deviance
+        self.errors = errors
+
+    def __repr__(self):
+        return 'FitResult<model: %s, taus: %s, chisquare: %s>' % (
+            self.model,
+            list(self.taus),
+            self.chisquare,
+        )
+
+    @property
+    def params(self):
+        r = {'chisquare': self.chisquare}
+        if self.deviance is not None:
+            r['deviance'] = self.deviance
+        for key, value in zip(TAU_KEYS, self.taus):
+            r[key] = value
+        for key, value in zip(IZERO_KEYS, self.izeros):
+            r[key] = value
+        return r
+
+    @property
+    def uncertainties(self):
+        """Standard errors by parameter name, 0 for fixed taus."""
+        if self.errors is None:
+            return {}
+        n = len(self.taus)
+        keys = TAU_KEYS[:n] + IZERO_KEYS[:n]
+        return dict(zip(keys, self.errors))
+
+    def text(self):
+        """Results as `name value` lines, the format the sidebar reads."""
+        r = []
+        w = r.append
+        w('model %s' % self.model)
+        if self.method != 'lsq':
+            w('method %s' % self.method)
+        errors = self.uncertainties
+        for i in range(len(self.taus)):
+            for key, value in ((TAU_KEYS[i], self.taus[i]),
+                               (IZERO_KEYS[i], self.izeros[i])):
+                w('%s %.6g' % (key, value))
+                if errors.get(key):
+                    w('%s_error %.2g' % (key, errors[key]))
+        if self.fixed:
+            w('fixed %s' % ','.join(self.fixed))
+        if self.irfshift:
+            w('irfshift %.6g' % self.irfshift)
+        w('chisquare %.6g' % self.chisquare)
+        if self.deviance is not None:
+            w('deviance %.6g' % self.deviance)
+        return '\n'.join(r)
+
+
+def fit_window(t, timestart=None, timeend=None):
+    """Index slice of `t` that lies inside [timestart, timeend]."""
+    window = time_window(t, timestart, timeend)
+    if window.stop - window.start < 2:
+        raise FitError('Fit window is empty.')
+    return window
+
+
+def _initial_taus(t, decay, n):
+    peak = decay.argmax()
+    tail = decay[peak:].astype(np.float64)
+    if tail.sum() > 0:
+        mean = np.dot(t[peak:] - t[peak], tail) / tail.sum()
+    else:
+        mean = t[-1] - t[0]
+    mean = max(mean, t[1] - t[0])
+    return mean * 2.0 ** (np.arange(n) - (n - 1) / 2.0)
+
+
+def _start_values(n, t, y, kwargs):
+    """Initial taus and izeros, guessed unless given in `kwargs`."""
+    taus = _initial_taus(t, y, n)
+    izeros = np.empty(n)
+    izeros.fill(y.max() / n)
+    for i in range(n):
+        taus[i] = _float(kwargs.get(TAU_KEYS[i]), taus[i])
+        izeros[i] = _float(kwargs.get(IZERO_KEYS[i]), izeros[i])
+    if np.any(taus <= 0):
+        raise FitError('Lifetimes must be positive.')
+    return taus, izeros
+
+
+def deviance(y, model):
+    """Poisson deviance of counts `y` per bin of `model`."""
+    m = np.maximum(model, MIN_COUNTS)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log = np.where(y > 0, y * np.log(y / m), 0.0)
+    return 2 * (m - y + log)
+
+
+def deviance_residuals(y, model):
+    """
+    Signed square roots of the deviance and their derivatives by the model,
+    the sum of squares of the residuals is the Poisson deviance.
+    """
+    m = np.maximum(model, MIN_COUNTS)
+    r = np.sign(m - y) * np.sqrt(np.maximum(deviance(y, m), 0))
+    # d r / d m = (1 - y/m) / r, which goes to 1/sqrt(m) as m -> y
+    close = np.abs(m - y) < 1e-6 * m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d_r = np.where(close, 1 / np.sqrt(m), (1 - y / m) / r)
+    d_r[model < MIN_COUNTS] = 0.0
+    return r, d_r
+
+
+def _std_errors(jac):
+    """Standard errors of the parameters from the Jacobian of the weighted
+    (or deviance) residuals at the optimum."""
+    cov = np.linalg.pinv(np.dot(jac.T, jac))
+    return np.sqrt(np.maximum(np.diag(cov), 0))
+
+
+def _model_size(model):
+    try:
+        return MODELS[model]
+    except KeyError:
+        raise FitError('Unknown model: %s' % model)
+
+
+def fit(t, decay, irf, model='exp1', timestart=None, timeend=None,
+        irfshift=None, fixed=None, callback=None, method='lsq', **kwargs):
+    """
+    Fit `decay` with a reconvolved multi-exponential model.
+
+    Takes the same keyword arguments as the sidebar collects: `tau`,
+    `izero`, `tau2`, ... initial values, `fixed` as a list or comma separated
+    string of taus to hold constant. Values may be given as strings.
+
+    `method='lsq'` minimises chi-square with weights from the counts,
+    `method='mle'` maximises the Poisson likelihood, which is unbiased on
+    low-count tails. The solver minimises the deviance residuals so both
+    share the Gauss-Newton steps and the analytic Jacobian.
+
+    `callback(nfev, chisquare)` is called after every model evaluation, the
+    fit is stopped with `FitCancelled` when it returns true.
+    """
+    n = _model_size(model)
+    if method not in METHODS:
+        raise FitError('Unknown fit method: %s' % method)
+
+    t = np.asarray(t, dtype=np.float64)
+    decay = np.asarray(decay, dtype=np.float64)
+    irf = np.asarray(irf, dtype=np.float64)
+    irfshift = _float(irfshift, 0.0)
+    fixed = _fixed(fixed)
+
+    window = fit_window(t, _float(timestart), _float(timeend))
+    # nothing past the window end affects the model inside it
+    with timer('fft setup'):
+        conv = Reconvolution(t[:window.stop], irf[:window.stop], irfshift)
+
+    y = decay[window]
+    weights = 1.0 / np.sqrt(np.maximum(y, 1.0))
+
+    taus, izeros = _start_values(n, t[window], y, kwargs)
+    free = np.array([TAU_KEYS[i] not in fixed for i in range(n)])
+
+    p0 = np.concatenate((taus[free], izeros))
+    lower = np.concatenate((np.zeros(free.sum()) + 1e-9 * conv.resolution,
+                            np.zeros(n)))
+    p0 = np.maximum(p0, lower)
+
+    def unpack(p):
+        tau = taus.copy()
+        tau[free] = p[:free.sum()]
+        return tau, p[free.sum():]
+
+    dof = max(len(y) - len(p0), 1)
+    nfev = [0]
+
+    def residuals(p):
+        tau, izero = unpack(p)
+        m = conv(tau, izero)[window]
+        if method == 'mle':
+            r = deviance_residuals(y, m)[0]
+        else:
+            r = (m - y) * weights
+        nfev[0] += 1
+        if callback is not None and callback(nfev[0], np.dot(r, r) / dof):
+            raise FitCancelled('Fit cancelled.')
+        return r
+
+    def jacobian(p):
+        tau, izero = unpack(p)
+        m, d_tau, d_izero = conv.evaluate(tau, izero)
+        jac = np.vstack((d_tau[free], d_izero))[:, window]
+        if method == 'mle':
+            return (jac * deviance_residuals(y, m[window])[1]).T
+        return (jac * weights).T
+
+    with timer('optimize'):
+        r = least_squares(residuals, p0, jac=jacobian,
+                          bounds=(lower, np.inf), x_scale='jac')
+
+    tau, izero = unpack(r.x)
+    m = conv(tau, izero)[window]
+    res = (m - y) * weights
+    errors = _std_errors(r.jac)
+    tau_errors = np.zeros(n)
+    tau_errors[free] = errors[:free.sum()]
+
+    return FitResult(
+        model=model,
+        t=t[window],
+        fit=m,
+        residuals=res,
+        taus=tau,
+        izeros=izero,
+        chisquare=np.dot(res, res) / dof,
+        fixed=tuple(TAU_KEYS[i] for i in range(n) if not free[i]),
+        irfshift=irfshift,
+        nfev=r.nfev,
+        method=method,
+        deviance=deviance(y, m).sum() / dof,
+        errors=np.concatenate((tau_errors, errors[free.sum():])),
+    )
+
+
+class GlobalFitResult(object):
+    """
+    Outcome of a global fit: `taus` are shared, `izeros` has one row per
+    curve, as have `fit`, `residuals` and `chisquares`.
+    """
+
+    def __init__(self, model, t, fit, residuals, taus, izeros, chisquare,
+                 chisquares, fixed=(), irfshift=0.0, nfev=0, method='lsq',
+                 deviances=None):
+        self.model = model
+        self.t = t
+        self.fit = fit
+        self.residuals = residuals
+        self.taus = taus
+        self.izeros = izeros
+        self.chisquare = chisquare
+        self.chisquares = chisquares
+        self.fixed = fixed
+        self.irfshift = irfshift
+        self.nfev = nfev
+        self.method = method
+        self.deviances = deviances
+
+    def __repr__(self):
+        return 'GlobalFitResult<model: %s, curves: %s, taus: %s>' % (
+            self.model,
+            len(self.izeros),
+            list(self.taus),
+        )
+
+    def __len__(self):
+        return len(self.izeros)
+
+    def curve(self, i):
+        """Result of curve `i` alone."""
+        deviance = None
+        if self.deviances is not None:
+            deviance = self.deviances[i]
+        return FitResult(self.model, self.t, self.fit[i], self.residuals[i],
+                         self.taus, self.izeros[i], self.chisquares[i],
+                         self.fixed, self.irfshift, self.nfev, self.method,
+                         deviance)
+
+
+def global_fit(t, decays, irf, model='exp1', timestart=None, timeend=None,
+               irfshift=None, fixed=None, callback=None, method='lsq',
+               **kwargs):
+    """
+    Fit all rows of `decays` at once with lifetimes shared by all curves
+    and amplitudes per curve.
+
+    Takes the same keyword arguments as `fit`, `izero` values are used as
+    the start value for every curve. The Jacobian is handed to the solver
+    as a sparse matrix: a dense block for the shared taus and a block
+    diagonal for the amplitudes.
+    """
+    n = _model_size(model)
+    if method not in METHODS:
+        raise FitError('Unknown fit method: %s' % method)
+
+    t = np.asarray(t, dtype=np.float64)
+    decays = np.atleast_2d(np.asarray(decays, dtype=np.float64))
+    irf = np.asarray(irf, dtype=np.float64)
+    irfshift = _float(irfshift, 0.0)
+    fixed = _fixed(fixed)
+
+    window = fit_window(t, _float(timestart), _float(timeend))
+    conv = Reconvolution(t[:window.stop], irf[:window.stop], irfshift)
+
+    y = decays[:, window]
+    weights = 1.0 / np.sqrt(np.maximum(y, 1.0))
+    ncurves, size = y.shape
+
+    taus, izero = _start_values(n, t[window], y.sum(axis=0), kwargs)
+    free = np.array([TAU_KEYS[i] not in fixed for i in range(n)])
+    nfree = free.sum()
+    izeros = np.outer(y.max(axis=1) / y.max(axis=1).max(), izero / ncurves)
+    if any(kwargs.get(k) for k in IZERO_KEYS[:n]):
+        izeros[:] = izero
+
+    p0 = np.concatenate((taus[free], izeros.ravel()))
+    lower = np.concatenate((np.zeros(nfree) + 1e-9 * conv.resolution,
+                            np.zeros(ncurves * n)))
+    p0 = np.maximum(p0, lower)
+
+    def unpack(p):
+        tau = taus.copy()
+        tau[free] = p[:nfree]
+        return tau, p[nfree:].reshape(ncurves, n)
+
+    dof = max(y.size - len(p0), 1)
+    nfev = [0]
+
+    def residuals(p):
+        tau, izero = unpack(p)
+        m = np.dot(izero, conv.components(tau)[:, window])
+        if method == 'mle':
+            r = deviance_residuals(y, m)[0].ravel()
+        else:
+            r = ((m - y) * weights).ravel()
+        nfev[0] += 1
+        if callback is not None and callback(nfev[0], np.dot(r, r) / dof):
+            raise FitCancelled('Fit cancelled.')
+        return r
+
+    # sparsity pattern of the amplitude block: curve i only depends on its
+    # own n amplitudes
+    rows = np.arange(ncurves * size).reshape(ncurves, size, 1)
+    rows = np.repeat(rows, n, axis=2)
+    cols = nfree + (np.arange(ncurves)[:, None, None] * n +
+                    np.arange(n)[None, None, :])
+    cols = np.repeat(cols, size, axis=1)
+    tau_rows = np.repeat(np.arange(ncurves * size), nfree)
+    tau_cols = np.tile(np.arange(nfree), ncurves * size)
+    rows = np.concatenate((tau_rows, rows.ravel()))
+    cols = np.concatenate((tau_cols, cols.ravel()))
+    shape = (ncurves * size, len(p0))
+
+    def jacobian(p):
+        tau, izero = unpack(p)
+        _, d_tau, d_izero = conv.evaluate(tau, np.ones(n))
+        d_tau = d_tau[free][:, window]
+        d_izero = d_izero[:, window]
+        scale = weights
+        if method == 'mle':
+            m = np.dot(izero, d_izero)
+            scale = deviance_residuals(y, m)[1]
+        # (curves, time, taus) blocks
+        tau_block = (izero[:, free][:, None, :] * d_tau.T[None, :, :] *
+                     scale[:, :, None])
+        izero_block = d_izero.T[None, :, :] * scale[:, :, None]
+        values = np.concatenate((tau_block.ravel(), izero_block.ravel()))
+        return sparse.csr_matrix((values, (rows, cols)), shape=shape)
+
+    with timer('optimize'):
+        r = least_squares(residuals, p0, jac=jacobian,
+                          bounds=(lower, np.inf), tr_solver='lsmr',
+                          x_scale='jac')
+
+    tau, izero = unpack(r.x)
+    m = np.dot(izero, conv.components(tau)[:, window])
+    res = (m - y) * weights
+
+    return GlobalFitResult(
+        model=model,
+        t=t[window],
+        fit=m,
+        residuals=res,
+        taus=tau,
+        izeros=izero,
+        chisquare=(res * res).sum() / dof,
+        chisquares=(res * res).sum(axis=1) / max(size - n, 1),
+        fixed=tuple(TAU_KEYS[i] for i in range(n) if not free[i]),
+        irfshift=irfshift,
+        nfev=r.nfev,
+        method=method,
+        deviances=deviance(y, m).sum(axis=1) / max(size - n, 1),
+    )
+
+
+def batch_fit(t, decays, irf, model='exp1', timestart=None, timeend=None,
+              irfshift=None, fixed=None, method='lsq', max_iterations=100,
+              weight_counts=None, **kwargs):
+    """
+    Fit every row of `decays` on its own, all in one batch.
+
+    Runs Levenberg-Marquardt on all curves at once: one FFT batch evaluates
+    all models and their Jacobians, the small normal equations of all curves
+    are solved together and every curve keeps its own damping. Meant for
+    many similar curves started close to the optimum, like resampled copies
+    of a fitted decay. `weight_counts` are the counts the least squares
+    weights are taken from, each curve's own by default. Returns `(taus,
+    izeros, chisquares)` with one row per curve.
+    """
+    n = _model_size(model)
+    if method not in METHODS:
+        raise FitError('Unknown fit method: %s' % method)
+
+    t = np.asarray(t, dtype=np.float64)
+    decays = np.atleast_2d(np.asarray(decays, dtype=np.float64))
+    irf = np.asarray(irf, dtype=np.float64)
+    fixed = _fixed(fixed)
+
+    window = fit_window(t, _float(timestart), _float(timeend))
+    conv = Reconvolution(t[:window.stop], irf[:window.stop],
+                         _float(irfshift, 0.0))
+
+    y = decays[:, window]
+    if weight_counts is None:
+        weight_counts = y
+    else:
+        weight_counts = np.asarray(weight_counts, dtype=np.float64)
+        weight_counts = np.broadcast_to(weight_counts[..., window], y.shape)
+    weights = 1.0 / np.sqrt(np.maximum(weight_counts, 1.0))
+    ncurves, size = y.shape
+
+    taus, izeros = _start_values(n, t[window], y.mean(axis=0), kwargs)
+    free = np.array([TAU_KEYS[i] not in fixed for i in range(n)])
+    nfree = free.sum()
+    k = nfree + n
+
+    lower = np.concatenate((np.zeros(nfree) + 1e-9 * conv.resolution,
+                            np.zeros(n)))
+    p = np.tile(np.maximum(np.concatenate((taus[free], izeros)), lower),
+                (ncurves, 1))
+
+    def unpack(p):
+        tau = np.tile(taus, (len(p), 1))
+        tau[:, free] = p[:, :nfree]
+        return tau, p[:, nfree:]
+
+    def residuals(p, y, weights):
+        tau, izero = unpack(p)
+        m = (izero[:, :, None] * conv.components(tau)).sum(axis=1)[:, window]
+        if method == 'mle':
+            return deviance_residuals(y, m)[0]
+        return (m - y) * weights
+
+    def jacobian(p, y, weights):
+        m, d_tau, d_izero = conv.evaluate(*unpack(p))
+        m = m[:, window]
+        # (curves, params, time)
+        jac = np.concatenate((d_tau[:, free], d_izero), axis=1)[..., window]
+        if method == 'mle':
+            r, scale = deviance_residuals(y, m)
+        else:
+            r = (m - y) * weights
+            scale = weights
+        return r, jac * scale[:, None, :]
+
+    damping = np.zeros(ncurves) + 1e-3
+    active = np.arange(ncurves)
+    eye = np.eye(k)
+    with timer('optimize'):
+        for i in range(max_iterations):
+            if not len(active):
+                break
+            pa, ya, wa = p[active], y[active], weights[active]
+            r, jac = jacobian(pa, ya, wa)
+            cost = (r * r).sum(axis=1)
+            a = np.einsum('bkt,blt->bkl', jac, jac)
+            g = np.einsum('bkt,bt->bk', jac, r)
+            diag = a[:, range(k), range(k)]
+            a = a + damping[active, None, None] * diag[:, :, None] * eye
+            step = np.linalg.solve(a, -g[..., None])[..., 0]
+            trial = np.maximum(pa + step, lower)
+            r = residuals(trial, ya, wa)
+            new_cost = (r * r).sum(axis=1)
+
+            better = new_cost < cost
+            p[active[better]] = trial[better]
+            damping[active[better]] /= 10
+            damping[active[~better]] *= 10
+            converged = (better & (cost - new_cost < 1e-10 * cost) |
+                         (damping[active] > 1e10))
+            active = active[~converged]
+
+    tau, izero = unpack(p)
+    m = (izero[:, :, None] * conv.components(tau)).sum(axis=1)[:, window]
+    res = (m - y) * weights
+    chisquares = (res * res).sum(axis=1) / max(size - k, 1)
+    return tau, izero, chisquares
+
+
+def map_batches(func, tasks, total, jobs=None, callback=None):
+    """
+    `func(task)` of every task in order, each returning arrays with one row
+    per fitted curve. `jobs=1` runs in this process, otherwise on a pool of
+    `jobs` processes (all cores by default). `callback(done, total)` is
+    called after every batch with the rows done so far, returning true
+    stops with `FitCancelled`.
+    """
+    pool = None
+    if jobs != 1 and len(tasks) > 1:
+        jobs = jobs or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        batches = pool.imap(func, tasks)
+    else:
+        batches = (func(task) for task in tasks)
+
+    results = []
+    done = 0
+    try:
+        for batch in batches:
+            results.append(batch)
+            done += len(batch[0])
+            if callback is not None and callback(done, total):
+                raise FitCancelled('Fit cancelled.')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return results
+
+
+def _rising_edge(curve):
+    return np.maximum(np.diff(curve), 0)
+
+
+def coarse_irf_shift(t, decay, irf):
+    """
+    IRF shift, in whole bins, that lines up the rising edges of IRF and
+    decay: the peak of their FFT cross-correlation.
+    """
+    a = _rising_edge(np.asarray(decay, dtype=np.float64))
+    b = _rising_edge(np.asarray(irf, dtype=np.float64))
+    nfft = _fft_size(len(a))
+    xcorr = np.fft.irfft(np.fft.rfft(a, nfft) * np.conj(np.fft.rfft(b, nfft)),
+                         nfft)
+    lag = xcorr.argmax()
+    if lag > nfft // 2:
+        lag -= nfft
+    return lag * (t[1] - t[0])
+
+
+def _scan_irf_shifts(conv, window, y, taus, shifts):
+    """Chi-square of every candidate shift with lifetimes held at `taus`."""
+    weights = 1.0 / np.sqrt(np.maximum(y, 1.0))
+
+    # (shifts, taus, time) design matrices of the linear amplitude problem
+    a = conv.shifted_components(taus, shifts)[:, :, window] * weights
+    b = y * weights
+    ata = np.einsum('skn,sjn->skj', a, a)
+    atb = np.einsum('skn,n->sk', a, b)
+    izeros = np.linalg.solve(ata, atb[..., None])[..., 0]
+
+    r = np.einsum('sk,skn->sn', izeros, a) - b
+    dof = max(len(y) - 2 * len(taus), 1)
+    return (r * r).sum(axis=1) / dof
+
+
+def find_irf_shift(t, decay, irf, model='exp1', timestart=None,
+                   timeend=None, span=2.0, step=0.05, rounds=3, **kwargs):
+    """
+    Search the IRF shift that gives the lowest chi-square.
+
+    The search starts at `coarse_irf_shift`. Every round fits the lifetimes
+    at the current best shift, then solves the amplitudes linearly for all
+    candidate shifts within +-`span` bins (in steps of `step` bins) in one
+    batch and moves to the best one.
+
+    A `callback` is passed on to every fit, so the search can be cancelled
+    like a fit. Returns `(shift, shifts, chisquare)` of the last round.
+    """
+    kwargs.pop('irfshift', None)
+
+    t = np.asarray(t, dtype=np.float64)
+    decay = np.asarray(decay, dtype=np.float64)
+    irf = np.asarray(irf, dtype=np.float64)
+    res = t[1] - t[0]
+
+    window = fit_window(t, _float(timestart), _float(timeend))
+    conv = Reconvolution(t[:window.stop], irf[:window.stop])
+    y = decay[window]
+    offsets = np.arange(-span, span + step / 2, step) * res
+
+    shift = coarse_irf_shift(t, decay, irf)
+    for i in range(rounds):
+        result = fit(t, decay, irf, model=model, timestart=timestart,
+                     timeend=timeend, irfshift=shift, **kwargs)
+        shifts = shift + offsets
+        chisquare = _scan_irf_shifts(conv, window, y, result.taus, shifts)
+        best = shifts[chisquare.argmin()]
+        if best == shift:
+            break
+        shift = best
+
+    return shift, shifts, chisquare
@@ -6,32 +6,32 @@ import re
 import sys
 import os
 import re
-import itertools
-import subprocess
-import tempfile
+import threading
+import Queue
+import sqlite3
 
 import numpy
 import gobject
 import gtk
-import tr_fit
 
 from matplotlib.figure import Figure
 from matplotlib.backends import backend_gtkagg
 from matplotlib.gridspec import GridSpec
 
-from picoharp import PicoharpParser
+import fitting
+import timing
+from core import Measurement, fit_kwargs
+from bootstrap import DEFAULT_SAMPLES
+from sweep import SweepResult, sweep
+from fitcache import FitCache
+from resultsdb import ResultsDB
+from datafiles import CurveCache, get_next_file
+from lod import Pyramid
 
 
 FigureCanvas = backend_gtkagg.FigureCanvasGTKAgg
 
 
-def array_shift(array, size):
-    array = numpy.resize(array, (len(array) + size, ))
-    array[size:] = array[:-size]
-    array[:size] = 0
-    return array
-
-
 def getfloat(value):
     try:
         return float(re.findall('-?[0-9.]+', value)[0])
@@ -39,60 +39,6 @@ def getfloat(value):
         return 0.0
 
 
-def get_next_file(filename, i=1, _listdir=os.listdir):
-    """
-    >>> ls = lambda n: ['a.txt', 'b.doc', 'c.txt']
-    >>> get_next_file('a.txt', 1, ls)
-    'c.txt'
-    >>> get_next_file('a.txt', -1, ls)
-    'c.txt'
-    >>> get_next_file('c.txt', -1, ls)
-    'a.txt'
-    >>> get_next_file('c.txt', 1, ls)
-    'a.txt'
-    """
-    d, filename = os.path.split(filename)
-    name, ext = filename.rsplit('.', 1)
-    fltr = lambda s: s.endswith(ext)
-    files = filter(fltr, _listdir(d))
-    files.sort()
-    index = files.index(filename) + i
-    if index >= len(files):
-        index -= len(files)
-    if index < 0:
-        index += len(files)
-    return os.path.join(d, files[index])
-
-
-class CSVFileParser(object):
-    def __init__(self, filename):
-        self.file = open(filename, 'r')
-
-    def get_curve(self, n):
-        self.file.seek(0)
-        ln = []
-        for line in self.file:
-            line = line.strip()
-            for char in (',', ' ', ';'):
-                try:
-                    ln.append(int(line.split(char)[n]))
-                except ValueError:
-                    ln.append(0)
-                    break
-                except IndexError:
-                    continue
-        return 0.0016, numpy.array(ln)
-
-
-def get_file_parser(filename):
-    d = {
-        '.csv': CSVFileParser,
-        '.phd': PicoharpParser,
-    }
-    filename[-4]
-    return d[filename[-4:]](filename)
-
-
 class Sidebar(object):
     def __init__(self, manager):
         builder = self.builder = gtk.Builder()
@@ -100,7 +46,16 @@ class Sidebar(object):
         builder.connect_signals(self)
         self.widget = builder.get_object('toplevel')
         self.manager = manager
-        
+        self.fits = FitQueue(self.on_fit_progress, self.on_fit_done)
+        try:
+            self.fit_cache = FitCache()
+        except OSError:
+            self.fit_cache = None
+        try:
+            self.results_db = ResultsDB()
+        except (OSError, sqlite3.Error):
+            self.results_db = None
+
     def __getitem__(self, key):
         item = self.builder.get_object(key)
         if not item:
@@ -108,16 +63,11 @@ class Sidebar(object):
         return item
 
     def build_kwargs(self):
-        kwargs = {
-            'model': self['model'].get_active_text()
-        }
-
+        values = {}
         for key in ['timestart', 'timeend', 'tau', 'izero', 'tau2', 'izero2',
                     'tau3', 'izero3', 'irfshift']:
             if self[key].get_sensitive():
-                value = self[key].get_text().strip()
-                if value:
-                    kwargs[key] = value
+                values[key] = self[key].get_text()
 
         fixed = []
 
@@ -128,31 +78,103 @@ class Sidebar(object):
         if self['fixed3'].get_active():
             fixed.append('tau3')
 
-        if fixed:
-            kwargs['fixed'] = ','.join(fixed)
-
-        return kwargs
+        method = self['mle'].get_active() and 'mle' or 'lsq'
+        return fit_kwargs(self['model'].get_active_text(), fixed, method,
+                          **values)
 
     def on_fitbtn_clicked(self, btn):
-        data = self.manager.export_to_tempfile()
-        fit = Fit(self.manager, data=data, **self.build_kwargs())
-        fit_data, comments = fit.run()
+        samples = self['bootstrap'].get_active() and DEFAULT_SAMPLES or 0
+        job = FitJob(self.manager.measurement, self.build_kwargs(),
+                     self.fit_cache, samples)
+        self.fits.submit(job)
+        self.update_fit_status()
+
+    def sweep(self):
+        """Fit every curve of the current file with the sidebar settings."""
+        job = SweepJob(self.manager.filename, self.build_kwargs())
+        self.fits.submit(job)
+        self.update_fit_status()
+
+    def on_fitcancel_clicked(self, btn):
+        self.fits.cancel()
+        self.update_fit_status()
+
+    def update_fit_status(self, text=None):
+        pending = self.fits.pending()
+        self['fitcancel'].set_sensitive(pending > 0)
+        if text is None:
+            text = pending and 'Fits queued: %d' % pending or ''
+        self['fitprogress'].set_text(text)
+        if not pending:
+            self['fitprogress'].set_fraction(0)
+
+    def on_fit_progress(self, job, nfev, chisquare):
+        name = os.path.basename(job.filename)
+        if job.stage in ('bootstrap', 'sweep'):
+            # nfev of chisquare resamples or curves are done
+            self['fitprogress'].set_fraction(nfev / float(chisquare))
+            self.update_fit_status('%s: %s %d of %d' % (
+                name, job.stage, nfev, chisquare))
+            return
+        self['fitprogress'].pulse()
+        self.update_fit_status('%s: iteration %d, chisquare %.4g' % (
+            name, nfev, chisquare))
+
+    def on_fit_done(self, job, result, error):
+        self.update_fit_status()
+        if job.cancelled or isinstance(error, fitting.FitCancelled):
+            # also jobs that finished after the last progress callback
+            return
+        if error is not None:
+            self['results'].get_buffer().set_text(str(error))
+            return
+        if isinstance(job, IrfShiftJob):
+            if job.measurement is self.manager.measurement:
+                self.set_irf_shift(result)
+            return
+        self.record(job, result)
+        if isinstance(result, SweepResult):
+            show_sweep(result)
+            return
+        if job.filename != self.manager.filename:
+            # the user moved on to another file, its plot is not ours
+            return
+        comments = result.text()
+        intervals = None
+        if job.bootstrap is not None:
+            comments += '\n' + job.bootstrap.text()
+            intervals = job.bootstrap.intervals()
+        with timing.collect(job.timings):
+            with timing.timer('plot'):
+                self.manager.write_results_text(
+                    errors=result.uncertainties, intervals=intervals,
+                    **result.params)
+                self.manager.plot_fit_data((result.t, result.fit,
+                                            result.residuals))
+                self.manager.fit_result = result
+                self.manager.fit_bootstrap = job.bootstrap
+        if timing.enabled:
+            comments += '\n\n' + job.timings.text()
+            timing.log('fit', **job.timings.record())
         self['results'].get_buffer().set_text(comments)
-        if fit_data:
-            results = self.parse_result_text(comments)
-            self.manager.write_results_text(**results)
-            self.manager.plot_fit_data(fit_data)
 
-    def parse_result_text(self, text):
-        r = {}
-        for line in text.splitlines():
-            line = line.strip().split()
-            if len(line) == 2:
-                try:
-                    r[line[0]] = float(line[1])
-                except ValueError:
-                    continue
-        return r
+    def record(self, job, result):
+        """Keep the fit in the results database."""
+        if self.results_db is None:
+            return
+        timestart = job.kwargs.get('timestart')
+        timeend = job.kwargs.get('timeend')
+        try:
+            if isinstance(result, SweepResult):
+                self.results_db.record_sweep(result, timestart, timeend)
+            else:
+                intervals = None
+                if job.bootstrap is not None:
+                    intervals = job.bootstrap.intervals()
+                self.results_db.record(job.filename, result, 1, timestart,
+                                       timeend, intervals)
+        except sqlite3.Error, e:
+            print >> sys.stderr, 'Could not record the fit: %s' % e
 
     def on_clear_clicked(self, btn):
         self.manager.clear_fit()
@@ -174,7 +196,15 @@ class Sidebar(object):
                 self[key].set_sensitive(exp >= i)
 
     def on_irfshiftbtn_clicked(self, btn):
-        value = getfloat(self['irfshift'].get_text())
+        self.set_irf_shift(getfloat(self['irfshift'].get_text()))
+
+    def on_irfshiftauto_clicked(self, btn):
+        # the search runs several fits, keep it off the main loop
+        job = IrfShiftJob(self.manager.measurement, self.build_kwargs())
+        self.fits.submit(job)
+        self.update_fit_status()
+
+    def set_irf_shift(self, value):
         value = self.manager.irf_shift(value)
         self['irfshift'].set_text('%.5f' % value)
 
@@ -188,9 +218,8 @@ class Sidebar(object):
             if len(args) != 2:
                 continue
             obj = self.builder.get_object(args[0])
-            if not obj:
-                continue
-            if args[0] == 'model':
+            # only the form fields, results like `model` name other widgets
+            if not isinstance(obj, gtk.Entry):
                 continue
             obj.set_text(args[1])
 
@@ -237,6 +266,16 @@ class Menu(gtk.MenuBar):
         i.connect('activate', self.on_file_save)
         filemenu.append(i)
 
+        i = gtk.MenuItem('Save as .npz')
+        i.show()
+        i.connect('activate', self.on_file_save_npz)
+        filemenu.append(i)
+
+        i = gtk.MenuItem('Fit all curves')
+        i.show()
+        i.connect('activate', self.on_file_sweep)
+        filemenu.append(i)
+
         i = gtk.SeparatorMenuItem()
         i.show()
         filemenu.append(i)
@@ -296,6 +335,12 @@ class Menu(gtk.MenuBar):
     def on_file_save(self, btn):
         self.manager.save_fit()
 
+    def on_file_save_npz(self, btn):
+        self.manager.save_fit('npz')
+
+    def on_file_sweep(self, btn):
+        self.manager.sidebar.sweep()
+
     def on_file_settings(self):
         pass
 
@@ -306,115 +351,215 @@ class Menu(gtk.MenuBar):
             self.manager.hide_irf()
 
 
-class Fit(object):
-    def __init__(self, manager, data, model, **kwargs):
-        self.manager = manager
-        self.data = data
-        self.model = model
+class FitJob(object):
+    """
+    A fit of a measurement, followed by bootstrap intervals from `samples`
+    resampled copies when `samples` is set.
+    """
+
+    def __init__(self, measurement, kwargs, cache=None, samples=0):
+        self.measurement = measurement
+        self.filename = measurement.filename
+        self.kwargs = kwargs
+        self.cache = cache
+        self.samples = samples
+        self.cancelled = False
+        self.stage = 'fit'
+        self.bootstrap = None
+        self.timings = timing.Timings(os.path.basename(self.filename))
+
+    def run(self, callback):
+        with timing.collect(self.timings):
+            with timing.timer('fit total'):
+                result = timing.profiled(self.measurement.fit, self.cache,
+                                         callback, **self.kwargs)
+            if self.samples:
+                self.stage = 'bootstrap'
+                with timing.timer('bootstrap'):
+                    self.bootstrap = self.measurement.bootstrap(
+                        result, self.samples, callback=callback,
+                        **self.kwargs)
+        return result
+
+
+class SweepJob(object):
+    """Fits of all curves of a file against its IRF, see `sweep.sweep`."""
+
+    stage = 'sweep'
+
+    def __init__(self, filename, kwargs):
+        self.filename = filename
         self.kwargs = kwargs
+        self.cancelled = False
+        self.timings = timing.Timings(os.path.basename(filename))
 
-    def run(self):
-        self.dialog = gtk.MessageDialog(self.manager.window,
-            gtk.DIALOG_MODAL,
-            gtk.MESSAGE_INFO,
-            gtk.BUTTONS_CANCEL,
-            message_format='Please wait...') 
-
-        box = self.dialog.get_children()[-1]
-        bar = self.bar = gtk.ProgressBar()
-        bar.show()
-        box.add(bar)
-
-        self.sub = self.start_sub_process()
-        self.start_loop()
-        self.dialog.run()
-        self.destroy()
-
-        return self.get_results()
-    
-    def start_sub_process(self):
-        d = os.path.dirname(tr_fit.__file__)
-        fitscript = os.path.join(d, 'main.py')
-        args = [sys.executable, 
-                fitscript,
-                'data=%s' % self.data,
-                'mode=fit,dump',
-                'model=%s' % self.model]
-
-        for k, v in self.kwargs.items():
-            args.append('='.join((k, v)))
-
-        self.p = subprocess.Popen(args, 
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.STDOUT)
-
-    def start_loop(self):
-        self._stop_loop = False
-        gobject.timeout_add(100, self._loop)
-
-    def stop_loop(self):
-        self._stop_loop = True
+    def run(self, callback):
+        with timing.collect(self.timings):
+            with timing.timer('sweep'):
+                return sweep(self.filename, callback=callback, **self.kwargs)
+
+
+class IrfShiftJob(object):
+    """Search of the IRF shift of a measurement, see `find_irf_shift`."""
+
+    stage = 'irf shift'
+
+    def __init__(self, measurement, kwargs):
+        self.measurement = measurement
+        self.filename = measurement.filename
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.timings = timing.Timings(os.path.basename(self.filename))
+
+    def run(self, callback):
+        with timing.collect(self.timings):
+            with timing.timer('irf shift'):
+                return self.measurement.find_irf_shift(callback=callback,
+                                                       **self.kwargs)
+
+
+def show_sweep(result):
+    """Summary plot of a sweep in a window of its own."""
+    figure = Figure()
+    canvas = FigureCanvas(figure)
+    result.plot(figure)
+    window = gtk.Window()
+    window.set_title('Sweep: %s' % os.path.basename(result.filename))
+    window.set_default_size(640, 480)
+    window.add(canvas)
+    window.show_all()
+    return window
+
+
+class FitQueue(object):
+    """
+    Runs fit jobs one after another on a worker thread.
+
+    `on_progress(job, nfev, chisquare)` and `on_done(job, result, error)`
+    are called from the GTK main loop.
+    """
+
+    def __init__(self, on_progress, on_done):
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self._queue = Queue.Queue()
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, job):
+        with self._lock:
+            self._jobs.append(job)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(job)
+
+    def pending(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def cancel(self):
+        """Cancel the running fit and all queued ones."""
+        with self._lock:
+            for job in self._jobs:
+                job.cancelled = True
+            self._jobs = []
 
     def _loop(self):
-        if self._stop_loop:
-            return False
-        self.loop()
-        return True
-
-    def loop(self):
-        self.bar.pulse()
-        r = self.p.poll()
-        if r != None:
-            self.destroy()
-
-    def destroy(self):
-        self.stop_loop()
-        self.dialog.destroy()
-        if self.p.poll() == None:
-            try:
-                self.p.kill()
-            except OSError:
-                pass
-
-    def get_results(self):
-        results = self.p.stdout.readlines()
-        for line in results:
-            if 'wrote ' in line:
-                f = line.strip().split('wrote ')[1]
-                return self._get_dumped_results(f)
-        return None, '\n'.join(results)
-
-    def _get_dumped_results(self, f):
-        f = open(f, 'r')
-        comments = []
-        x = []
-        y1 = []
-        y2 = []
-
-        for line in f:
-            line = line.strip()
-            if line.startswith('#'):
-                comments.append(line.strip().strip('#').strip())
-                continue
-            line = line.split()
-            if len(line) == 0:
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
                 continue
-            x.append(float(line[0]))
-            y1.append(float(line[2])) # fit
-            y2.append(float(line[3])) # residuals
 
-        x = numpy.array(x)
-        y1 = numpy.array(y1)
-        y2 = numpy.array(y2)
+            def callback(nfev, chisquare):
+                timing.count('evaluations')
+                if not job.cancelled:
+                    gobject.idle_add(self.on_progress, job, nfev, chisquare)
+                return job.cancelled
 
-        return (x,y1,y2), '\n'.join(comments[1:-1])
+            result = error = None
+            try:
+                result = job.run(callback)
+            except Exception, e:
+                # keep the worker alive, the error is shown in the sidebar
+                error = e
+
+            with self._lock:
+                if job in self._jobs:
+                    self._jobs.remove(job)
+            gobject.idle_add(self.on_done, job, result, error)
+
+
+class Renderer(object):
+    """
+    Coalesces draw requests into one per main loop iteration.
+
+    `draw` re-renders the whole figure, `update` only the animated artists
+    on top of the background cached after the last full draw.
+    """
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.artists = []
+        self._background = None
+        self._pending = None
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def animate(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+
+    def forget(self, artist):
+        if artist in self.artists:
+            self.artists.remove(artist)
+
+    def draw(self):
+        self._schedule(True)
 
+    def update(self):
+        self._schedule(False)
+
+    def _schedule(self, full):
+        if self._pending is None:
+            self._pending = full
+            gobject.idle_add(self._flush)
+        else:
+            self._pending = self._pending or full
+
+    def _flush(self):
+        full = self._pending
+        self._pending = None
+        if full or self._background is None:
+            with timing.timer('draw'):
+                self.canvas.draw()
+        else:
+            with timing.timer('blit'):
+                self.canvas.restore_region(self._background)
+                self._draw_artists()
+                self.canvas.blit(self.canvas.figure.bbox)
+        return False
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            if artist.get_visible():
+                artist.axes.draw_artist(artist)
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_artists()
 
 
 class Manager(backend_gtkagg.FigureManagerGTKAgg):
     def __init__(self, canvas, num):
         backend_gtkagg.FigureManagerGTKAgg.__init__(self, canvas, num)
         self.window.maximize()
+        self.cache = CurveCache()
+        self.lod = {}
+        self.fit_data = None
+        self.fit_result = None
+        self.fit_bootstrap = None
 
         self.vbox.remove(self.canvas)
 
@@ -449,7 +594,13 @@ class Manager(backend_gtkagg.FigureManagerGTKAgg):
             transform=self.ax.transAxes,
             fontsize=20,
         )
-        
+
+        self.renderer = Renderer(self.canvas)
+        self.renderer.animate(self.text)
+
+        self.ax.callbacks.connect('xlim_changed', self.update_lod)
+        self.canvas.mpl_connect('resize_event', self.update_lod)
+
         self.reset_margins()
 
     def load_data_file(self, filename):
@@ -459,38 +610,44 @@ class Manager(backend_gtkagg.FigureManagerGTKAgg):
             line = getattr(self, attr, None)
             if line:
                 line.remove()
+                self.renderer.forget(line)
                 setattr(self, attr, None)
                 del line
 
-        data = get_file_parser(filename)
-        res, curve1 = data.get_curve(0)
-        res, curve2 = data.get_curve(1)
-        size = len(curve1)
-        X = numpy.arange(0, size*res, res, numpy.float)
-        self.resolution = res
-
-        for i, v in enumerate(reversed(curve1)):
-            if v > 0:
-                break
+        with timing.timer('load file'):
+            self.measurement = Measurement.load(filename, self.cache)
+        curves = self.curves = self.measurement.curves
+        self.resolution = curves.resolution
 
-        curve1 = curve1[:-i]
-        curve2 = curve2[:-i]
-        X = X[:-i]
-
-        self.decay = self.ax.plot(X, curve2, 'b.')[0]
-        self.irf = self.ax.plot(X, curve1, 'r.')[0]
+        # the fit axis, fits and residuals line up with the data
+        t = curves.t
+        self.lod = {}
+        self.decay = self.plot_lod(self.ax, 'decay', t, curves.decay, 'b.')
+        self.irf = self.plot_lod(self.ax, 'irf', t, curves.irf, 'r.')
+        self.renderer.animate(self.irf)
 
         self.fit = None
         self.res = None
+        self.fit_data = None
+        self.fit_result = None
+        self.fit_bootstrap = None
 
         self.ax.set_yscale('log')
         self.text.set_text(r'$\tau_1 = ?$')
         self.window.set_title(os.path.basename(filename))
-        self.canvas.draw()
+        self.renderer.draw()
 
         self.menu.file_prev.set_sensitive(True)
         self.menu.file_next.set_sensitive(True)
 
+        try:
+            neighbours = [get_next_file(filename, 1),
+                          get_next_file(filename, -1)]
+        except (OSError, ValueError):
+            # prefetching is best effort, never fail a load over it
+            neighbours = []
+        self.cache.prefetch(neighbours)
+
     def reset_margins(self):
         w, h = self.canvas.get_width_height()
         top = 1 - 5.0/h
@@ -499,88 +656,92 @@ class Manager(backend_gtkagg.FigureManagerGTKAgg):
         left = 20.0/h
         self.canvas.figure.subplots_adjust(
             top=top, right=right, bottom=bottom, left=left)
-        self.canvas.draw()
+        self.renderer.draw()
+
+    def plot_lod(self, ax, name, x, y, style):
+        """Plot a curve through a level-of-detail pyramid."""
+        pyramid = self.lod[name] = Pyramid(x, y)
+        x, y = pyramid.select(-numpy.inf, numpy.inf, self.ax.bbox.width)
+        return ax.plot(x, y, style)[0]
+
+    def update_lod(self, event=None):
+        """Swap every curve to the level that fits the visible x range."""
+        xmin, xmax = self.ax.get_xlim()
+        pixels = self.ax.bbox.width
+        for name, pyramid in self.lod.items():
+            line = getattr(self, name)
+            if line is None:
+                continue
+            shift = getattr(line, '_shift', 0)
+            x, y = pyramid.select(xmin - shift, xmax - shift, pixels)
+            line.set_data(x + shift, y)
 
     def reset_shift(self, draw=False):
         for curve in (self.decay, self.irf):
-            if getattr(curve, '_shift', 0) != 0:
-                curve.set_xdata(curve.get_xdata() - curve._shift)
-                curve._shift = 0
+            curve._shift = 0
+        self.update_lod()
 
     def irf_shift(self, value):
-        self.reset_shift()
-        value = round(value / self.resolution) * self.resolution
-
-        curve = self.irf
-        curve._shift = value
-
-        curve.set_xdata(curve.get_xdata() + curve._shift)
-        self.canvas.draw()
+        self.measurement.irfshift = value
+        self.decay._shift = 0
+        self.irf._shift = value
+        self.update_lod()
+        self.renderer.update()
 
         return value
 
-    def iter_data(self):
-        decay = self.decay.get_ydata()
-        irf = self.irf.get_ydata()
-
-        t = self.resolution
-
-        #if getattr(self.decay, '_shift', 0) > 0:
-        #    size = int(self.decay._shift / self.resolution)
-        #    decay = array_shift(decay, size)
-
-        #if getattr(self.irf, '_shift', 0) > 0:
-        #    size = int(self.irf._shift / self.resolution)
-        #    irf = array_shift(irf, size)
-
-        for a, b in itertools.izip(decay, irf):
-            yield t, a, b
-            t += self.resolution
-
-    def export_to_tempfile(self):
-        f, filename = tempfile.mkstemp()
-        
-        for t, a, b in self.iter_data():
-            os.write(f, '%f,%d,%d\n' % (t, a, b))
+    def get_data(self):
+        return self.measurement.data()
 
-        os.close(f)
-
-        return filename
+    def iter_data(self):
+        return self.measurement.iter_data()
 
     def plot_fit_data(self, data):
         self.clear_fit()
 
-        x, y1, y2 = data
+        x, y1, y2 = self.fit_data = data
 
-        self.fit = self.ax.plot(x, y1, 'g-')[0]
-        self.res = self.ax2.plot(x, y2, 'c-')[0] # residuals
+        self.fit = self.plot_lod(self.ax, 'fit', x, y1, 'g-')
+        self.res = self.plot_lod(self.ax2, 'res', x, y2, 'c-') # residuals
 
-        self.canvas.draw()
+        self.renderer.draw()
 
     def write_results_text(self, tau=0, izero=0, 
                                  tau2=0, izero2=0,
                                  tau3=0, izero3=0,
-                                 chisquare=0,
-                                 **kwargs):
+                                 chisquare=0, deviance=None, errors=None,
+                                 intervals=None, **kwargs):
         r = []
+        errors = errors or {}
+        intervals = intervals or {}
+
+        def value(key, x):
+            if key in intervals:
+                return '%.4g [%.4g, %.4g]' % ((x, ) + intervals[key])
+            if errors.get(key):
+                return r'%.4g \pm %.2g' % (x, errors[key])
+            return '%.4g' % x
 
         s = sum((tau*izero, tau2*izero2, tau3*izero3))
 
         s1 = int(round(tau * izero / s * 100))
         suf = (tau2 > 0 and '_1' or '')
-        r.append(r'$\tau%s = %s (%s\%%)$ ' % (suf, tau, s1))
+        r.append(r'$\tau%s = %s (%s\%%)$ ' % (suf, value('tau', tau), s1))
 
         if tau2 != 0:
             s2 = int(round(tau2 * izero2 / s * 100))
-            r.append(r'$\tau_2 = %s (%s\%%)$' % (tau2, s2))
+            r.append(r'$\tau_2 = %s (%s\%%)$' % (value('tau2', tau2), s2))
 
         if tau3 != 0:
             s3 = int(round(tau3 * izero3 / s * 100))
-            r.append(r'$\tau_3 = %s (%s\%%)$' % (tau3, s3))
+            r.append(r'$\tau_3 = %s (%s\%%)$' % (value('tau3', tau3), s3))
 
-        r.append(r'$\chi^2 = %s$' % chisquare)
+        r.append(r'$\chi^2 = %.4g$' % chisquare)
+        if deviance is not None:
+            r.append(r'$D = %.4g$' % deviance)
 
         self.text.set_text('\n'.join(r))
+        self.renderer.update()
 
     def clear_fit(self):
         if self.fit:
@@ -589,45 +750,37 @@ class Manager(backend_gtkagg.FigureManagerGTKAgg):
             self.ax2.lines.remove(self.res)
         self.fit = None
         self.res = None
-        self.canvas.draw()
+        self.fit_data = None
+        self.fit_result = None
+        self.fit_bootstrap = None
+        self.lod.pop('fit', None)
+        self.lod.pop('res', None)
+        self.renderer.draw()
 
     def show_irf(self):
         if self.irf:
-            if self.irf not in self.ax.lines:
-                self.ax.add_line(self.irf)
-                self.canvas.draw()
+            self.irf.set_visible(True)
+            self.renderer.update()
 
     def hide_irf(self):
-        self.irf.remove()
-        self.canvas.draw()
+        if self.irf:
+            self.irf.set_visible(False)
+            self.renderer.update()
 
-    def save_fit(self):
-        if not self.fit:
+    def save_fit(self, format='dat'):
+        if self.fit_result is None:
             return
-        if not self.filename.endswith('.phd'):
-            filename = self.filename + '.dat'
-        else:
-            filename = re.sub('.phd$', '.dat', self.filename)
-        f = open(filename, 'w')
-
-        fit_x = self.fit.get_xdata()
-        fit_y = self.fit.get_ydata()
-        decay_x = self.decay.get_xdata()
-        decay_y = self.decay.get_ydata()
-
-        first = fit_x[0]
-        for i, x in enumerate(decay_x):
-            if x >= first:
-                start = i
-                break
-
-        data = itertools.izip(fit_x, decay_y[start:], fit_y)
-
-        f.write('%f\t%d\t%d' % data.next())
+        intervals = None
+        if self.fit_bootstrap is not None:
+            intervals = self.fit_bootstrap.intervals()
+        try:
+            filename = self.measurement.save_fit(self.fit_result, format,
+                                                 intervals=intervals)
+        except (IOError, ValueError), e:
+            print >> sys.stderr, 'Could not save the fit: %s' % e
+            return
+        print >> sys.stderr, 'Saved %s.' % filename
 
-        for row in data:
-            f.write('\n%f\t%d\t%d' % row)
-        
 
 def new_figure_manager(num, *args, **kwargs):
     """
@@ -640,6 +793,7 @@ def new_figure_manager(num, *args, **kwargs):
 
 
 def main():
+    gobject.threads_init()
     manager = new_figure_manager(0)
     manager.window.show()
     manager.window.connect("destroy", gtk.main_quit)
@@ -0,0 +1,67 @@
+"""
+Level-of-detail copies of curves for plotting
+
+A `Pyramid` keeps min/max decimated levels of a curve, level k merges 2**k
+bins into a minimum and a maximum point so peaks and dips survive. `select`
+picks the coarsest level that still gives a couple of points per pixel for
+the visible x range.
+"""
+import numpy
+
+# levels are built until they are this small
+MIN_LEVEL_SIZE = 512
+
+# points per pixel to aim for when picking a level
+POINTS_PER_PIXEL = 2
+
+
+class Pyramid(object):
+    def __init__(self, x, y):
+        self.x = numpy.asarray(x)
+        self.y = numpy.asarray(y)
+        self.levels = []
+
+        lo = hi = self.y
+        while len(lo) > MIN_LEVEL_SIZE:
+            if len(lo) % 2:
+                lo = numpy.append(lo, lo[-1])
+                hi = numpy.append(hi, hi[-1])
+            lo = numpy.minimum(lo[0::2], lo[1::2])
+            hi = numpy.maximum(hi[0::2], hi[1::2])
+            self.levels.append((lo, hi))
+
+    def __len__(self):
+        return len(self.x)
+
+    def level_for(self, visible, pixels):
+        """Level that shows `visible` bins on `pixels` pixels."""
+        level = 0
+        target = max(int(pixels), 1) * POINTS_PER_PIXEL
+        while level < len(self.levels) and (visible >> level) > target:
+            level += 1
+        return level
+
+    def select(self, xmin, xmax, pixels):
+        """
+        Points to draw for the x range [xmin, xmax] on `pixels` pixels.
+
+        Full resolution data is returned as a view, coarser levels as
+        interleaved min/max pairs placed at the start of each bucket.
+        """
+        start = max(numpy.searchsorted(self.x, xmin, side='left') - 1, 0)
+        stop = numpy.searchsorted(self.x, xmax, side='right') + 1
+        level = self.level_for(stop - start, pixels)
+
+        if level == 0:
+            return self.x[start:stop], self.y[start:stop]
+
+        lo, hi = self.levels[level - 1]
+        start >>= level
+        stop = min((stop >> level) + 1, len(lo))
+        step = 1 << level
+
+        x = self.x[start * step:stop * step:step]
+        y = numpy.empty(2 * len(x), dtype=lo.dtype)
+        y[0::2] = lo[start:start + len(x)]
+        y[1::2] = hi[start:start + len(x)]
+        return numpy.repeat(x, 2), y
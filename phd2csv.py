@@ -1,32 +1,87 @@
+"""
+Convert PicoHarp 300 files to CSV (or .npz)
+
+Usage: phd2csv.py <*.phd>... [format=csv|npz] [trim=1] [jobs=N]
+
+Every curve of a file becomes a column after the time column. With `trim=1`
+the bins past the last non-empty bin of the IRF (curve 0) are left out.
+Several files are converted in parallel.
+"""
 import picoharp
 import numpy
 import sys
+import itertools
+import multiprocessing
 
+from preprocess import trim_stop
 
-def main():
-    if len(sys.argv) != 2:
-        print 'Usage: %s <*.phd>' % __file__
-        sys.exit(1)
+CHUNK_ROWS = 8192
 
-    _, datafile = sys.argv
 
-    parser = picoharp.PicoharpParser(datafile)
+def write_csv(f, X, curves):
+    """Write time and curve columns in blocks of `CHUNK_ROWS` rows."""
+    linefmt = '%f' + ',%d' * len(curves) + '\n'
+    for start in range(0, len(X), CHUNK_ROWS):
+        block = numpy.vstack((X[start:start + CHUNK_ROWS],
+                              curves[:, start:start + CHUNK_ROWS])).T
+        f.write((linefmt * len(block)) % tuple(block.ravel()))
+
+
+def convert(datafile, format='csv', trim=False):
+    parser = picoharp.PicoharpParser(datafile, mmap=True)
     name, ext = datafile.rsplit('.', 1)
 
-    res, curve1 = parser.get_curve(0)
-    res, curve2 = parser.get_curve(1)
-    size = len(curve1)
-    X = numpy.arange(0, size*res, res, numpy.float)
+    curves = parser.curves()
+    if trim:
+        curves = curves[:, :trim_stop(curves[0])]
+    res = parser.get_curve(0)[0]
+    X = numpy.arange(curves.shape[1]) * res
+
+    outname = '%s.%s' % (name, format)
+
+    if format == 'npz':
+        numpy.savez(outname, time=X, curves=curves, resolution=res)
+    else:
+        f = open(outname, 'w')
+        try:
+            write_csv(f, X, curves)
+        finally:
+            f.close()
+
+    parser.close()
+    return outname
+
+
+def _convert(args):
+    return convert(*args)
+
+
+def main():
+    files = [a for a in sys.argv[1:] if '=' not in a]
+    kwargs = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)
+
+    if not files or kwargs.get('format', 'csv') not in ('csv', 'npz'):
+        print __doc__.strip()
+        sys.exit(1)
 
-    csvname = '%s.csv' % name
-    csv = open(csvname, 'w')
+    format = kwargs.get('format', 'csv')
+    trim = kwargs.get('trim', '0') not in ('0', '')
+    tasks = [(f, format, trim) for f in files]
 
-    for x, y1, y2 in zip(X, curve1, curve2):
-        csv.write('%f,%d,%d\n' % (x, y1, y2))
+    pool = None
+    if len(tasks) > 1:
+        jobs = int(kwargs.get('jobs', 0)) or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap(_convert, tasks)
+    else:
+        results = itertools.imap(_convert, tasks)
 
-    csv.close()
+    for outname in results:
+        print 'Saved %s.' % outname
 
-    print 'Saved %s.' % csvname
+    if pool:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
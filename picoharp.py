@@ -2,9 +2,11 @@
 PicoHarp 300 file parser
 """
 import datetime
+import mmap
 import numpy as np
-from ctypes import c_uint, c_ulong, c_char, c_int, c_int64, c_float, \
-                   Structure, sizeof, memmove, addressof
+from timing import timer
+from ctypes import c_uint, c_uint32, c_char, c_int, c_int64, c_float, \
+                   Structure, Array, sizeof
 
 DISPCURVES = 8
 MAXCURVES = 512
@@ -86,25 +88,25 @@ class BoardHdr(Structure):
                 ('Resolution', c_float),
                 ('RouterModelCode', c_int),
                 ('RouterEnabled', c_int),
-                ('RtChan1_InputType;', c_int),
+                ('RtChan1_InputType', c_int),
                 ('RtChan1_InputLevel', c_int),
                 ('RtChan1_InputEdge', c_int),
                 ('RtChan1_CFDPresent', c_int),
                 ('RtChan1_CFDLevel', c_int),
                 ('RtChan1_CFDZeroCross', c_int),
-                ('RtChan2_InputType;', c_int),
+                ('RtChan2_InputType', c_int),
                 ('RtChan2_InputLevel', c_int),
                 ('RtChan2_InputEdge', c_int),
                 ('RtChan2_CFDPresent', c_int),
                 ('RtChan2_CFDLevel', c_int),
                 ('RtChan2_CFDZeroCross', c_int),
-                ('RtChan3_InputType;', c_int),
+                ('RtChan3_InputType', c_int),
                 ('RtChan3_InputLevel', c_int),
                 ('RtChan3_InputEdge', c_int),
                 ('RtChan3_CFDPresent', c_int),
                 ('RtChan3_CFDLevel', c_int),
                 ('RtChan3_CFDZeroCross', c_int),
-                ('RtChan4_InputType;', c_int),
+                ('RtChan4_InputType', c_int),
                 ('RtChan4_InputLevel', c_int),
                 ('RtChan4_InputEdge', c_int),
                 ('RtChan4_CFDPresent', c_int),
@@ -117,7 +119,7 @@ class CurveHdr(Structure):
     _pack_ = 4
     _fields_ = [
                 ('CurveIndex', c_int),
-                ('TimeOfRecording', c_ulong),
+                ('TimeOfRecording', c_uint32),
                 ('HardwareIdent', c_char * 16),
                 ('HardwareVersion', c_char * 8),
                 ('HardwareSerial', c_int),
@@ -148,7 +150,7 @@ class CurveHdr(Structure):
                 ('DataOffset', c_int),
                 ('RouterModelCode', c_int),
                 ('RouterEnabled', c_int),
-                ('RtChan_InputType;', c_int),
+                ('RtChan_InputType', c_int),
                 ('RtChan_InputLevel', c_int),
                 ('RtChan_InputEdge', c_int),
                 ('RtChan_CFDPresent', c_int),
@@ -160,11 +162,32 @@ class CurveHdr(Structure):
 class ParseError(Exception): pass
 
 
-def _read(f, CType):
-    data = f.read(sizeof(CType))
-    obj = CType()
-    memmove(addressof(obj), data, len(data))
-    return obj
+def _dtype(CType):
+    """Little-endian numpy dtype with the layout of a ctypes type."""
+    if issubclass(CType, Structure):
+        return np.dtype([(name, _dtype(t)) for name, t in CType._fields_])
+    if issubclass(CType, Array):
+        if CType._type_ is c_char:
+            return np.dtype('S%d' % CType._length_)
+        return np.dtype((_dtype(CType._type_), (CType._length_, )))
+    return np.dtype('<%s%d' % (np.dtype(CType).kind, sizeof(CType)))
+
+
+TXTHDR = _dtype(TxtHdr)
+BINHDR = _dtype(BinHdr)
+BOARDHDR = _dtype(BoardHdr)
+CURVEHDR = _dtype(CurveHdr)
+
+
+def _records(data, dtype, count=1, offset=0):
+    if len(data) < offset + dtype.itemsize * count:
+        raise ParseError('Does not look like a PicoHarp 300 file.')
+    array = np.frombuffer(data, dtype, count, offset)
+    return array.view(np.recarray)
+
+
+def _mmap(f):
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 def _validate_header(header):
@@ -189,44 +212,147 @@ def timefmt(t):
 
 
 class PicoharpParser(object):
+    """
+    With `mmap=True` the file is memory mapped and `get_curve` and `curves`
+    return read-only views into the mapping instead of copies.
+
+    Only the headers are read up front. The parser is a context manager that
+    closes the file on exit, `iter_curves` streams the curves one at a time.
+    """
     _ready = False
+    _map = None
 
-    def __init__(self, filename):
+    def __init__(self, filename, mmap=False):
         if isinstance(filename, (str, unicode)):
             filename = open(filename, mode='rb')
         self.f = filename
         self._prepare()
+        if mmap:
+            self._map = _mmap(self.f)
 
     def _prepare(self):
+        with timer('parse headers'):
+            self._read_headers()
+
+    def _read_headers(self):
         self.f.seek(0)
 
-        header = self._header = _read(self.f, TxtHdr)
+        data = self.f.read(TXTHDR.itemsize + BINHDR.itemsize)
+        header = self._header = _records(data, TXTHDR)[0]
         _validate_header(header)
 
-        bin_header = self._bin_header = _read(self.f, BinHdr)
+        bin_header = self._bin_header = _records(data, BINHDR,
+                                                 offset=TXTHDR.itemsize)[0]
 
-        self._boards = []
-        for i in range(bin_header.NumberOfBoards):
-            self._boards.append(_read(self.f, BoardHdr))
+        boards = bin_header.NumberOfBoards
+        curves = bin_header.Curves
+        if not 0 <= curves <= MAXCURVES or boards < 0:
+            raise ParseError('Corrupt PicoHarp 300 file header.')
 
-        self._curves = []
-        for i in range(bin_header.Curves):
-            self._curves.append(_read(self.f, CurveHdr))
+        data = self.f.read(BOARDHDR.itemsize * boards +
+                           CURVEHDR.itemsize * curves)
+        self._boards = _records(data, BOARDHDR, boards)
+        self._curves = _records(data, CURVEHDR, curves,
+                                BOARDHDR.itemsize * boards)
 
     def header(self):
-        return [(k, getattr(self._header, k)) for k, t in self._header._fields_]
+        return [(k, self._header[k]) for k in TXTHDR.names]
 
     def no_of_curves(self):
-        return self._bin_header.Curves
-
-    def get_curve(self, n):
+        return int(self._bin_header.Curves)
+
+    def curve_headers(self):
+        """
+        Headers of all curves as a record array, each field is a column:
+        `curve_headers().IntegralCount`.
+        """
+        return self._curves
+
+    def sweep_parameter(self):
+        """
+        Sweep parameter of every curve: the per-curve `P1` when it varies,
+        else the first `BinHdr.Params` Start/Step definition, else the curve
+        number.
+        """
+        curves = self._curves
+        p1 = curves.P1.astype(np.float64)
+        if len(p1) > 1 and np.any(p1 != p1[0]):
+            return p1
+        start = float(self._bin_header.Params['Start'][0])
+        step = float(self._bin_header.Params['Step'][0])
+        if step:
+            return start + step * np.arange(len(curves))
+        return np.arange(len(curves), dtype=np.float64)
+
+    def _read_array(self, offset, count):
+        if self._map is not None:
+            return np.frombuffer(self._map, c_uint, count, offset)
+        with timer('read data'):
+            self.f.seek(offset)
+            return np.fromfile(self.f, c_uint, count)
+
+    def _bins(self, header, start, stop):
+        channels = int(header.Channels)
+        start, stop, _ = slice(start, stop).indices(channels)
+        return start, max(start, stop)
+
+    def get_curve(self, n, start=0, stop=None):
+        """Resolution and the bins [start:stop] of curve `n`."""
         header = self._curves[n]
-        res = header.Resolution
+        res = float(header.Resolution)
+        start, stop = self._bins(header, start, stop)
+        array = self._read_array(header.DataOffset + start * sizeof(c_uint),
+                                 stop - start)
+        return res, array
 
-        self.f.seek(header.DataOffset)
-        array = np.fromfile(self.f, c_uint, header.Channels)
+    def iter_curves(self, start=0, stop=None, select=None):
+        """
+        Yield `(header, data)` for every curve, reading only the bins
+        [start:stop] of one curve at a time. `select(header)` can skip curves
+        by their header before any data is read:
+
+            parser.iter_curves(select=lambda h: h.IntegralCount > 10000)
+        """
+        for n, header in enumerate(self._curves):
+            if select is not None and not select(header):
+                continue
+            yield header, self.get_curve(n, start, stop)[1]
+
+    def curves(self):
+        """
+        All curves as one 2-D array, one row per curve.
+
+        When the curves have the same size and are stored back to back this
+        is a single read (or a view in mmap mode), otherwise the curves are
+        read one by one and stacked.
+        """
+        curves = self._curves
+        if not len(curves):
+            return np.zeros((0, 0), c_uint)
 
-        return res, array
+        size = curves.Channels[0]
+        stride = size * sizeof(c_uint)
+        offsets = curves.DataOffset[0] + np.arange(len(curves)) * stride
+        contiguous = (np.all(curves.Channels == size) and
+                      np.all(curves.DataOffset == offsets))
+
+        if contiguous:
+            first = curves[0]
+            array = self._read_array(first.DataOffset, size * len(curves))
+            return array.reshape(len(curves), size)
+
+        return np.vstack([self.get_curve(i)[1] for i in range(len(curves))])
+
+    def close(self):
+        # curve views keep the mapping alive until they are released
+        self._map = None
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def info(self):
         txthdr = self._header
@@ -266,16 +392,16 @@ class PicoharpParser(object):
         for i in range(DISPCURVES):
             w("---------------------")
             w("Curve No %s" % i)
-            w(" MapTo           : %s" % binhdr.DispCurves[i].MapTo)
-            w(" Show            : %s" % yesno(binhdr.DispCurves[i].Show))
+            w(" MapTo           : %s" % binhdr.DispCurves['MapTo'][i])
+            w(" Show            : %s" % yesno(binhdr.DispCurves['Show'][i]))
             w("---------------------")
 
         for i in range(3):
             w("---------------------")
             w("Parameter No %s" % i)
-            w(" Start           : %f" % binhdr.Params[i].Start)
-            w(" Step            : %f" % binhdr.Params[i].Step)
-            w(" End             : %f" % binhdr.Params[i].End)
+            w(" Start           : %f" % binhdr.Params['Start'][i])
+            w(" Step            : %f" % binhdr.Params['Step'][i])
+            w(" End             : %f" % binhdr.Params['End'][i])
             w("---------------------")
 
         w("Repeat Mode      : %d" % binhdr.RepeatMode)
@@ -334,7 +460,7 @@ class PicoharpParser(object):
             for i, curve in enumerate(curves):
                 w("---------------------")
                 w("Curve Index       : %d" % curve.CurveIndex)
-                w("Time of Recording : %s" % timefmt(curve.TimeOfRecording))
+                w("Time of Recording : %s" % timefmt(int(curve.TimeOfRecording)))
                 w("HardwareIdent     : %s" % curve.HardwareIdent)
                 w("HardwareVersion   : %s" % curve.HardwareVersion)
                 w("HardwareSerial    : %d" % curve.HardwareSerial)
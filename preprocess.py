@@ -0,0 +1,57 @@
+"""
+Preprocessing of decay and IRF curves before plotting and fitting
+"""
+import numpy
+
+
+def trim_stop(irf):
+    """Index just past the last non-empty IRF bin."""
+    nonzero = numpy.flatnonzero(irf)
+    if not len(nonzero):
+        return 0
+    return nonzero[-1] + 1
+
+
+def time_window(t, timestart=None, timeend=None):
+    """Index slice of the sorted time axis `t` inside [timestart, timeend]."""
+    start = 0
+    stop = len(t)
+    if timestart is not None:
+        start = numpy.searchsorted(t, timestart, side='left')
+    if timeend is not None:
+        stop = numpy.searchsorted(t, timeend, side='right')
+    return slice(start, max(start, stop))
+
+
+class Curves(object):
+    """
+    Trimmed decay and IRF of one measurement. `decay` may also be a 2-D
+    array with one decay per row, all measured with the same IRF.
+
+    `irf` and `decay` are views into the loaded arrays. `t` holds the end
+    time of every bin, the axis fits are done on and plots are drawn on.
+    """
+
+    def __init__(self, resolution, irf, decay):
+        self.resolution = resolution
+        self.irf = irf
+        self.decay = decay
+
+    def __repr__(self):
+        return 'Curves<resolution: %s, size: %s>' % (
+            self.resolution,
+            len(self)
+        )
+
+    def __len__(self):
+        return self.irf.shape[-1]
+
+    @property
+    def t(self):
+        return numpy.arange(1, len(self) + 1) * self.resolution
+
+
+def prepare(resolution, irf, decay):
+    """Cut off the bins past the last non-empty IRF bin."""
+    stop = trim_stop(irf)
+    return Curves(resolution, irf[:stop], decay[..., :stop])
@@ -0,0 +1,272 @@
+"""
+SQLite store of fit results
+
+Every fit is a row of the `fits` table: the data file and curve, metadata
+from the curve header, the fit settings and the fitted parameters. The table
+is indexed by file, fit date, recording date and model so aggregating over
+thousands of fits is a query.
+
+Usage: resultsdb.py [db=path] [file=...] [model=...] [since=unix time]
+                    [until=unix time]
+
+Exports the matching fits as CSV to stdout.
+"""
+import os
+import sys
+import time
+import sqlite3
+
+import numpy as np
+
+from datafiles import get_file_parser
+from fitting import TAU_KEYS, IZERO_KEYS
+from picoharp import ParseError
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.local', 'share',
+                            'picoharp300-curvefit', 'results.sqlite')
+
+# (name, SQL type) of the columns after `id`
+COLUMNS = [
+    ('created', 'REAL'),
+    ('file', 'TEXT'),
+    ('curve', 'INTEGER'),
+    ('recorded', 'INTEGER'),
+    ('integral_count', 'INTEGER'),
+    ('resolution', 'REAL'),
+    ('channels', 'INTEGER'),
+    ('model', 'TEXT'),
+    ('method', 'TEXT'),
+    ('tau', 'REAL'),
+    ('izero', 'REAL'),
+    ('tau2', 'REAL'),
+    ('izero2', 'REAL'),
+    ('tau3', 'REAL'),
+    ('izero3', 'REAL'),
+    ('chisquare', 'REAL'),
+    ('deviance', 'REAL'),
+    ('timestart', 'REAL'),
+    ('timeend', 'REAL'),
+    ('irfshift', 'REAL'),
+    ('fixed', 'TEXT'),
+]
+
+# bootstrap intervals
+COLUMNS += [('%s_%s' % (key, end), 'REAL')
+            for key in ('tau', 'izero', 'tau2', 'izero2', 'tau3', 'izero3')
+            for end in ('low', 'high')]
+
+NAMES = [name for name, _ in COLUMNS]
+
+INDEXES = ['file', 'created', 'recorded', 'model']
+
+FILTERS = {
+    'file': 'file = ?',
+    'curve': 'curve = ?',
+    'model': 'model = ?',
+    'method': 'method = ?',
+    'since': 'created >= ?',
+    'until': 'created < ?',
+}
+
+_NUMPY_TYPES = {'REAL': np.float64, 'INTEGER': np.int64, 'TEXT': object}
+
+
+def _number(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def file_metadata(filename):
+    """Header values of every curve of a file that go into `fits`."""
+    data = get_file_parser(filename)
+    try:
+        if not hasattr(data, 'curve_headers'):
+            # .csv files only know the resolution and the number of bins
+            return [{'resolution': data.resolution, 'channels': len(c)}
+                    for c in data.curves()]
+        return [{'resolution': float(h.Resolution),
+                 'channels': int(h.Channels),
+                 'recorded': int(h.TimeOfRecording),
+                 'integral_count': int(h.IntegralCount)}
+                for h in data.curve_headers()]
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
+
+
+def fit_row(filename, result, curve=1, metadata=None, timestart=None,
+            timeend=None, intervals=None):
+    """
+    Row of the `fits` table for a `fitting.FitResult` and its bootstrap
+    `intervals`.
+    """
+    row = dict(metadata or {})
+    row.update(result.params)
+    for key, (low, high) in (intervals or {}).items():
+        row[key + '_low'] = float(low)
+        row[key + '_high'] = float(high)
+    row.update(
+        file=os.path.abspath(filename),
+        curve=curve,
+        model=result.model,
+        method=result.method,
+        irfshift=result.irfshift,
+        fixed=','.join(result.fixed),
+        timestart=_number(timestart),
+        timeend=_number(timeend),
+    )
+    return row
+
+
+class ResultsDB(object):
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self._create()
+
+    def _create(self):
+        columns = ', '.join('%s %s' % c for c in COLUMNS)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS fits '
+                '(id INTEGER PRIMARY KEY, %s)' % columns)
+            # stores made before a column existed
+            existing = set(row[1] for row in self.connection.execute(
+                'PRAGMA table_info(fits)'))
+            for column in COLUMNS:
+                if column[0] not in existing:
+                    self.connection.execute(
+                        'ALTER TABLE fits ADD COLUMN %s %s' % column)
+            for name in INDEXES:
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS fits_%s ON fits (%s)' %
+                    (name, name))
+
+    def close(self):
+        self.connection.close()
+
+    def insert(self, rows):
+        """Add rows (dicts keyed by column name) in one transaction."""
+        now = time.time()
+        values = []
+        for row in rows:
+            row = dict(row)
+            row.setdefault('created', now)
+            values.append([row.get(name) for name in NAMES])
+        sql = 'INSERT INTO fits (%s) VALUES (%s)' % (
+            ', '.join(NAMES), ', '.join('?' * len(NAMES)))
+        with self.connection:
+            self.connection.executemany(sql, values)
+        return len(values)
+
+    def record(self, filename, result, curve=1, timestart=None,
+               timeend=None, intervals=None):
+        """
+        Add a single fit of `filename`, with the curve header metadata and
+        the bootstrap `intervals` if given.
+        """
+        try:
+            metadata = file_metadata(filename)[curve]
+        except (IOError, ParseError, ValueError, IndexError):
+            # the data file may be gone, the fit is still worth keeping
+            metadata = None
+        self.insert([fit_row(filename, result, curve, metadata, timestart,
+                             timeend, intervals)])
+
+    def record_sweep(self, result, timestart=None, timeend=None):
+        """Add every curve of a `sweep.SweepResult`."""
+        try:
+            metadata = file_metadata(result.filename)
+        except (IOError, ParseError, ValueError):
+            metadata = None
+        rows = []
+        for j, curve in enumerate(result.curves):
+            row = dict(metadata and metadata[curve] or {})
+            for i in range(result.taus.shape[1]):
+                row[TAU_KEYS[i]] = float(result.taus[j, i])
+                row[IZERO_KEYS[i]] = float(result.izeros[j, i])
+            row.update(file=os.path.abspath(result.filename),
+                       curve=int(curve), model=result.model,
+                       method=result.method,
+                       irfshift=float(result.irfshift),
+                       fixed=','.join(result.fixed),
+                       chisquare=float(result.chisquares[j]),
+                       timestart=_number(timestart),
+                       timeend=_number(timeend))
+            rows.append(row)
+        return self.insert(rows)
+
+    def _select(self, columns, filters):
+        columns = columns or NAMES
+        for name in columns:
+            if name not in NAMES and name != 'id':
+                raise ValueError('Unknown column: %s' % name)
+        where = []
+        args = []
+        for key, value in sorted(filters.items()):
+            if key not in FILTERS:
+                raise ValueError('Unknown filter: %s' % key)
+            if key == 'file':
+                value = os.path.abspath(value)
+            where.append(FILTERS[key])
+            args.append(value)
+        sql = 'SELECT %s FROM fits' % ', '.join(columns)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY created, id'
+        return columns, self.connection.execute(sql, args)
+
+    def query(self, columns=None, **filters):
+        """
+        Matching fits as a list of tuples of `columns` (all by default).
+        Filters: file, curve, model, method, since and until (fit time).
+        """
+        return self._select(columns, filters)[1].fetchall()
+
+    def array(self, columns=None, **filters):
+        """Matching fits as a numpy structured array, NULL as nan."""
+        columns, cursor = self._select(columns, filters)
+        types = dict(COLUMNS, id='INTEGER')
+        dtype = []
+        for name in columns:
+            kind = _NUMPY_TYPES[types[name]]
+            if kind is np.int64:
+                # NULLs need a float column
+                kind = np.float64
+            dtype.append((name, kind))
+        rows = [tuple(np.nan if v is None and k is not object else v
+                      for v, (n, k) in zip(row, dtype))
+                for row in cursor]
+        return np.array(rows, dtype=dtype)
+
+    def export_csv(self, f, columns=None, **filters):
+        columns, cursor = self._select(columns, filters)
+        f.write(','.join(columns) + '\n')
+        for row in cursor:
+            f.write(','.join('' if v is None else
+                             unicode(v).replace(',', ';').encode('utf-8')
+                             for v in row))
+            f.write('\n')
+
+
+def main():
+    kwargs = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)
+    if len(kwargs) != len(sys.argv[1:]):
+        print __doc__.strip()
+        sys.exit(1)
+    db = ResultsDB(kwargs.pop('db', DEFAULT_PATH))
+    try:
+        db.export_csv(sys.stdout, **kwargs)
+    except ValueError, e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Fit every curve of a multi-curve file against one IRF
+
+Usage: sweep.py <file> [irf=0] [output=sweep.csv] [plot=sweep.png] [jobs=N]
+                [name=value]...
+
+Repeat-mode and parameter-sweep acquisitions hold many decays measured with
+the same IRF. Every curve except the IRF is fitted on its own, in batches
+spread over a process pool, and the results are ordered by the sweep
+parameter of the curves (see `PicoharpParser.sweep_parameter`). The fit
+parameters are the ones batchfit.py accepts.
+"""
+import sys
+
+import numpy as np
+
+import fitting
+from fitting import TAU_KEYS, IZERO_KEYS
+from datafiles import get_file_parser
+from preprocess import prepare
+
+# curves fitted together in one `fitting.batch_fit` call
+BATCH_SIZE = 32
+
+
+class SweepResult(object):
+    """
+    Fit parameters of every curve, one row per curve, ordered by the sweep
+    `parameter`. `curves` holds the curve numbers in the file, `irfshift`,
+    `fixed` and `method` the settings all curves were fitted with.
+    """
+
+    def __init__(self, filename, model, parameter, curves, taus, izeros,
+                 chisquares, irfshift=0.0, fixed=(), method='lsq'):
+        self.filename = filename
+        self.model = model
+        self.parameter = parameter
+        self.curves = curves
+        self.taus = taus
+        self.izeros = izeros
+        self.chisquares = chisquares
+        self.irfshift = irfshift
+        self.fixed = fixed
+        self.method = method
+
+    def __repr__(self):
+        return 'SweepResult<%s, model: %s, curves: %s>' % (
+            self.filename, self.model, len(self))
+
+    def __len__(self):
+        return len(self.curves)
+
+    def write_csv(self, f):
+        n = self.taus.shape[1]
+        columns = ['parameter', 'curve']
+        for i in range(n):
+            columns += [TAU_KEYS[i], IZERO_KEYS[i]]
+        columns.append('chisquare')
+        f.write(','.join(columns) + '\n')
+        for j in range(len(self)):
+            row = [self.parameter[j], self.curves[j]]
+            for i in range(n):
+                row += [self.taus[j, i], self.izeros[j, i]]
+            row.append(self.chisquares[j])
+            f.write(','.join('%.6g' % v for v in row) + '\n')
+
+    def plot(self, figure):
+        """Summary plot of lifetimes and chi-square against the parameter."""
+        ax = figure.add_subplot(211)
+        for i in range(self.taus.shape[1]):
+            ax.plot(self.parameter, self.taus[:, i], '.-',
+                    label=TAU_KEYS[i])
+        ax.set_ylabel('lifetime')
+        ax.legend(loc='best')
+        ax2 = figure.add_subplot(212, sharex=ax)
+        ax2.plot(self.parameter, self.chisquares, 'k.')
+        ax2.set_xlabel('sweep parameter')
+        ax2.set_ylabel(r'$\chi^2$')
+        return figure
+
+
+def _fit_batch(args):
+    t, decays, irf, kwargs = args
+    taus, izeros, chisquares = fitting.batch_fit(t, decays, irf, **kwargs)
+    return taus, izeros, chisquares
+
+
+def sweep(filename, irf=0, jobs=None, callback=None, **kwargs):
+    """
+    Fit every curve of `filename` except curve `irf` with that IRF, takes
+    `fitting.fit` keyword arguments.
+
+    The mean of all decays is fitted first and its parameters start every
+    curve's fit. `jobs=1` fits in this process, otherwise on a pool of
+    `jobs` processes (all cores by default). `callback(done, curves)` is
+    called after every batch, returning true stops with `FitCancelled`.
+    """
+    irf = int(irf)
+    data = get_file_parser(filename)
+    try:
+        curves = data.curves()
+        parameter = data.sweep_parameter()
+        res = data.get_curve(irf)[0]
+    finally:
+        if hasattr(data, 'close'):
+            data.close()
+
+    indices = np.array([i for i in range(len(curves)) if i != irf])
+    if not len(indices):
+        raise fitting.FitError('No curves to fit besides the IRF.')
+    prepared = prepare(res, np.array(curves[irf]), curves[indices])
+    t, decays = prepared.t, prepared.decay
+
+    kwargs = dict(kwargs)
+    kwargs.pop('callback', None)
+    model = kwargs.setdefault('model', 'exp1')
+    if kwargs.get('irfshift') == 'auto':
+        del kwargs['irfshift']
+        kwargs['irfshift'], _, _ = fitting.find_irf_shift(
+            t, decays.mean(axis=0), prepared.irf, **kwargs)
+    start = fitting.fit(t, decays.mean(axis=0), prepared.irf, **kwargs)
+    for i in range(len(start.taus)):
+        kwargs[TAU_KEYS[i]] = start.taus[i]
+        kwargs[IZERO_KEYS[i]] = start.izeros[i]
+    kwargs['irfshift'] = start.irfshift
+
+    tasks = [(t, decays[i:i + BATCH_SIZE], prepared.irf, kwargs)
+             for i in range(0, len(decays), BATCH_SIZE)]
+
+    results = fitting.map_batches(_fit_batch, tasks, len(decays), jobs,
+                                  callback)
+    taus, izeros, chisquares = [np.concatenate(r) for r in zip(*results)]
+    order = np.argsort(parameter[indices], kind='mergesort')
+    return SweepResult(filename, model, parameter[indices][order],
+                       indices[order], taus[order], izeros[order],
+                       chisquares[order], start.irfshift, start.fixed,
+                       start.method)
+
+
+def main():
+    files = [a for a in sys.argv[1:] if '=' not in a]
+    kwargs = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)
+    if len(files) != 1:
+        print __doc__.strip()
+        sys.exit(1)
+
+    output = kwargs.pop('output', None)
+    plot = kwargs.pop('plot', None)
+    jobs = int(kwargs.pop('jobs', 0)) or None
+    result = sweep(files[0], jobs=jobs, **kwargs)
+
+    if output:
+        f = open(output, 'w')
+        try:
+            result.write_csv(f)
+        finally:
+            f.close()
+        print >> sys.stderr, 'Saved %s.' % output
+    else:
+        result.write_csv(sys.stdout)
+
+    if plot:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        result.plot(figure).savefig(plot)
+        print >> sys.stderr, 'Saved %s.' % plot
+
+
+if __name__ == '__main__':
+    main()
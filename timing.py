@@ -0,0 +1,170 @@
+"""
+Lightweight timers and counters for the hot paths
+
+Timing is off unless `PICOHARP_TIMING` is set in the environment or
+`enable()` is called, `timer` then costs one attribute lookup. When on,
+every timed stage is added to the `Timings` collected by the current thread
+(see `collect`) and, with a log file, written as a JSON line:
+
+    PICOHARP_TIMING=1 PICOHARP_TIMING_LOG=timings.jsonl python gui.py
+
+`PICOHARP_PROFILE=fit.prof` captures a cProfile of the next fit.
+"""
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+
+enabled = bool(os.environ.get('PICOHARP_TIMING'))
+
+# JSON lines log, '-' for stderr, None for no log
+log_file = os.environ.get('PICOHARP_TIMING_LOG')
+
+_profile_file = os.environ.get('PICOHARP_PROFILE')
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+def enable(log=None):
+    global enabled, log_file
+    enabled = True
+    if log is not None:
+        log_file = log
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+class Timings(object):
+    """Seconds spent per stage and counters of one task, e.g. one fit."""
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.seconds = {}
+        self.counters = {}
+
+    def add(self, stage, seconds):
+        if stage not in self.seconds:
+            self.stages.append(stage)
+            self.seconds[stage] = 0.0
+        self.seconds[stage] += seconds
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def text(self):
+        """Breakdown as `stage milliseconds` lines."""
+        r = []
+        for stage in self.stages:
+            r.append('%-14s %8.1f ms' % (stage, self.seconds[stage] * 1000))
+        for counter in sorted(self.counters):
+            r.append('%-14s %8d' % (counter, self.counters[counter]))
+        return '\n'.join(r)
+
+    def record(self):
+        return {'name': self.name,
+                'stages': dict(self.seconds),
+                'counters': dict(self.counters)}
+
+
+def current():
+    return getattr(_local, 'timings', None)
+
+
+class collect(object):
+    """Add the stages timed on this thread to `timings` while active."""
+
+    def __init__(self, timings):
+        self.timings = timings
+
+    def __enter__(self):
+        self._previous = current()
+        _local.timings = self.timings
+        return self.timings
+
+    def __exit__(self, *exc_info):
+        _local.timings = self._previous
+
+
+class _Null(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null = _Null()
+
+
+class _Timer(object):
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        timings = current()
+        if timings is not None:
+            timings.add(self.stage, seconds)
+        if log_file:
+            log('stage', stage=self.stage, seconds=seconds)
+
+
+def timer(stage):
+    """Context manager that times `stage` when timing is enabled."""
+    if not enabled:
+        return _null
+    return _Timer(stage)
+
+
+def count(counter, n=1):
+    timings = current()
+    if enabled and timings is not None:
+        timings.count(counter, n)
+
+
+def log(event, **fields):
+    """Write `fields` as one JSON line to the log file."""
+    if not log_file:
+        return
+    fields['event'] = event
+    fields['time'] = time.time()
+    fields['thread'] = threading.current_thread().name
+    line = json.dumps(fields, sort_keys=True) + '\n'
+    with _log_lock:
+        if log_file == '-':
+            sys.stderr.write(line)
+            return
+        f = open(log_file, 'a')
+        try:
+            f.write(line)
+        finally:
+            f.close()
+
+
+def profile_next(filename):
+    """Capture a cProfile of the next `profiled` call into `filename`."""
+    global _profile_file
+    _profile_file = filename
+
+
+def profiled(func, *args, **kwargs):
+    """Call `func`, under cProfile if a capture was requested."""
+    global _profile_file
+    filename, _profile_file = _profile_file, None
+    if not filename:
+        return func(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(filename)
+        log('profile', file=filename)